@@ -0,0 +1,96 @@
+import queue
+import threading
+import time
+
+import torch
+
+
+class BatchLoader:
+    # Assembles batches on a background thread. Each batch is one index_select
+    # over a strided view of every (block_size + 1) window, written into a
+    # ring of reusable (pinned, on CUDA) buffers in the data's own compact
+    # dtype, and widened to long on the way to the device. data may also be
+    # a list of shards; windows are then drawn uniformly across all of them
+    # and never span two shards. A loader created with skip=n produces the
+    # same batches as one that has already handed out n of them. With
+    # world_size processes, each rank draws from its own contiguous stripe of
+    # the windows with its own generator stream, seeded seed + rank.
+    def __init__(self, data, batch_size, block_size, device, seed=None, prefetch=2, skip=0, rank=0, world_size=1):
+        shards = data if isinstance(data, (list, tuple)) else [data]
+        self.windows = [shard.unfold(0, block_size + 1, 1) for shard in shards]
+        counts = torch.tensor([len(windows) for windows in self.windows])
+        self.starts = torch.cumsum(counts, 0) - counts
+        self.total = int(counts.sum())
+        self.low = self.total * rank // world_size
+        self.high = self.total * (rank + 1) // world_size
+        if self.high <= self.low:
+            raise ValueError(f"Rank {rank} of {world_size} gets no windows: {self.total} windows of "
+                             f"{block_size + 1} tokens in the data")
+        self.batch_size = batch_size
+        self.device = device
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed + rank)
+        self.seed = self.generator.initial_seed() - rank
+        self.skip = skip
+        self.batches = skip
+        pin = device == 'cuda'
+        self.buffers = [torch.empty((batch_size, block_size + 1), dtype=shards[0].dtype, pin_memory=pin)
+                        for _ in range(prefetch + 2)]
+        # A buffer is only refilled once the copy that last read it is done.
+        self.copied = [None] * len(self.buffers)
+        self.ready = queue.Queue(maxsize=prefetch)
+        self.thread = None
+        # How long the last next() waited for the background thread.
+        self.wait_seconds = 0.0
+
+    def _fill(self):
+        # An error ends the thread and is handed to next() in place of a
+        # batch, to be raised on the training thread.
+        try:
+            self._fill_buffers()
+        except Exception as error:
+            self.ready.put(error)
+
+    def _fill_buffers(self):
+        # The thread prefetches ahead of the batches handed out, so the
+        # generator state cannot be saved; resuming replays the index draws.
+        for _ in range(self.skip):
+            torch.randint(self.high - self.low, (self.batch_size,), generator=self.generator)
+        slot = 0
+        while True:
+            if self.copied[slot] is not None:
+                self.copied[slot].synchronize()
+            ix = self.low + torch.randint(self.high - self.low, (self.batch_size,), generator=self.generator)
+            if len(self.windows) == 1:
+                torch.index_select(self.windows[0], 0, ix, out=self.buffers[slot])
+            else:
+                shard_ids = torch.searchsorted(self.starts, ix, right=True) - 1
+                for shard in shard_ids.unique().tolist():
+                    rows = (shard_ids == shard).nonzero().squeeze(1)
+                    self.buffers[slot][rows] = self.windows[shard][ix[rows] - self.starts[shard]]
+            self.ready.put(slot)
+            slot = (slot + 1) % len(self.buffers)
+
+    def next(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._fill, daemon=True)
+            self.thread.start()
+        start = time.perf_counter()
+        slot = self.ready.get()
+        self.wait_seconds = time.perf_counter() - start
+        if isinstance(slot, Exception):
+            # Put back, so every later call raises it too instead of waiting.
+            self.ready.put(slot)
+            raise slot
+        self.batches += 1
+        buffer = self.buffers[slot]
+        non_blocking = self.device == 'cuda'
+        x = buffer[:, :-1].to(self.device, torch.long, non_blocking=non_blocking, copy=True)
+        y = buffer[:, 1:].to(self.device, torch.long, non_blocking=non_blocking, copy=True)
+        if self.device == 'cuda':
+            self.copied[slot] = torch.cuda.Event()
+            self.copied[slot].record()
+        return x, y
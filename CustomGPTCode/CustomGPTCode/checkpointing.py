@@ -0,0 +1,83 @@
+import os
+import re
+import threading
+
+import torch
+
+# Checkpoints are written as checkpoint_<iteration>.pt, zero-padded so the
+# file names sort by iteration. That order picks the newest checkpoint to
+# resume from and the oldest ones to delete.
+CHECKPOINT_PATTERN = re.compile(r'checkpoint_(\d+)\.pt$')
+
+
+def snapshot(value):
+    # Copies every tensor of a (nested) state dict to the CPU, so training can
+    # keep updating the live tensors while the copy is being written.
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: snapshot(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(item) for item in value)
+    return value
+
+
+def list_checkpoints(directory):
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for name in os.listdir(directory):
+        match = CHECKPOINT_PATTERN.match(name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(directory, name)))
+    return [path for _, path in sorted(found)]
+
+
+def latest_checkpoint(directory):
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1] if checkpoints else None
+
+
+class CheckpointWriter:
+    # Writes checkpoints on a background thread. Each one goes to a temporary
+    # file that is renamed into place once it is on disk, so a crash mid-write
+    # never leaves a truncated checkpoint behind. Only the newest keep
+    # checkpoints are kept.
+    def __init__(self, directory, keep=3):
+        if keep < 1:
+            raise ValueError(f"keep must be at least 1, got {keep}")
+        self.directory = directory
+        self.keep = keep
+        self.thread = None
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, iteration, state):
+        # state must already be a snapshot. At most one write is in flight, so
+        # a save waits for the previous one to finish.
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(iteration, state))
+        self.thread.start()
+
+    def _write(self, iteration, state):
+        try:
+            path = os.path.join(self.directory, f"checkpoint_{iteration:08d}.pt")
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as file:
+                torch.save(state, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, path)
+            for old_path in list_checkpoints(self.directory)[:-self.keep]:
+                os.remove(old_path)
+        except Exception as error:
+            self.error = error
+
+    def wait(self):
+        # Raises the error of a failed write here, on the training thread.
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
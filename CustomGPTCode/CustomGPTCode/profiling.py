@@ -0,0 +1,94 @@
+import os
+import time
+
+from torch.profiler import ProfilerActivity, profile, record_function, schedule
+
+
+class Profiler:
+    # Profiles a window of steps of one kind, 'train' (optimizer steps) or
+    # 'generate' (sampled tokens): steps start .. start + steps - 1 are
+    # recorded with per-operator CPU time, shapes and memory. The step before
+    # the window runs traced but is discarded, so one-off setup costs do not
+    # skew it. From that step on, the given module types are labelled in the
+    # trace; the label hooks are only added then, because a compiled model
+    # recompiles when its hooks change and that belongs in the discarded step.
+    # Afterwards the profiler and labels are removed, and a Chrome trace and
+    # top-N operator tables are written to output_dir.
+    def __init__(self, target, model, module_types, start=10, steps=5, top=20, output_dir='profiles', device='cpu'):
+        self.target = target
+        self.model = model
+        self.module_types = module_types
+        self.top = top
+        self.output_dir = output_dir
+        self.step_num = 0
+        self.end = start + steps
+        activities = [ProfilerActivity.CPU]
+        if str(device).startswith('cuda'):
+            activities.append(ProfilerActivity.CUDA)
+        warmup = 1 if start > 0 else 0
+        self.profile = profile(
+            activities=activities,
+            schedule=schedule(wait=start - warmup, warmup=warmup, active=steps, repeat=1),
+            on_trace_ready=self._export,
+            record_shapes=True,
+            profile_memory=True,
+        )
+        self.label_at = start - warmup
+        self.handles = []
+        if self.label_at == 0:
+            self._label()
+        self.profile.start()
+        self.running = True
+
+    def _label(self):
+        # Each module's forward becomes a named range, e.g. blocks.3.sa.
+        for name, module in self.model.named_modules():
+            if isinstance(module, self.module_types):
+                scopes = []
+
+                def enter(module, args, name=name, scopes=scopes):
+                    scope = record_function(f"{type(module).__name__} {name}")
+                    scope.__enter__()
+                    scopes.append(scope)
+
+                def exit(module, args, output, scopes=scopes):
+                    scopes.pop().__exit__(None, None, None)
+
+                self.handles.append(module.register_forward_pre_hook(enter))
+                self.handles.append(module.register_forward_hook(exit))
+
+    def step(self, kind):
+        if kind != self.target or not self.running:
+            return
+        self.profile.step()
+        self.step_num += 1
+        if self.step_num == self.label_at:
+            self._label()
+        if self.step_num == self.end:
+            self.close()
+
+    def close(self):
+        # Also called when the run ends early; a window that was cut short is
+        # still written, one that never opened is not.
+        if self.running:
+            self.profile.stop()
+            self.running = False
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def _export(self, prof):
+        os.makedirs(self.output_dir, exist_ok=True)
+        stem = os.path.join(self.output_dir, f"{self.target}_{time.strftime('%Y%m%d-%H%M%S')}")
+        prof.export_chrome_trace(stem + '_trace.json')
+        averages = prof.key_averages()
+        tables = [
+            'Operators by self CPU time',
+            averages.table(sort_by='self_cpu_time_total', row_limit=self.top),
+            'Operators by self CPU memory',
+            averages.table(sort_by='self_cpu_memory_usage', row_limit=self.top),
+        ]
+        with open(stem + '_ops.txt', 'w') as file:
+            file.write('\n\n'.join(tables) + '\n')
+        print(tables[1])
+        print(f"Profile saved as {stem}_trace.json and {stem}_ops.txt")
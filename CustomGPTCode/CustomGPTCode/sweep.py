@@ -0,0 +1,208 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import queue
+import random
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+train_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+METADATA_PATTERN = re.compile(r'model_state_dict_v(\d+)_metadata\.json$')
+
+# The search space is a JSON object mapping train.py settings to values. For
+# a grid search every value is a list, and every combination is one trial.
+# For a random search a value may also be a distribution:
+#   {"n_head": [4, 8], "n_layer": {"int": [4, 12]}, "learning_rate": {"log_uniform": [1e-4, 1e-3]}}
+
+
+def grid_configs(space):
+    names = sorted(space)
+    for name in names:
+        if not isinstance(space[name], list):
+            raise ValueError(f"A grid search needs a list of values for {name}")
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+
+def sample_value(spec, rng):
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    if isinstance(spec, dict) and len(spec) == 1:
+        (kind, (low, high)), = spec.items()
+        if kind == 'uniform':
+            return rng.uniform(low, high)
+        if kind == 'log_uniform':
+            return math.exp(rng.uniform(math.log(low), math.log(high)))
+        if kind == 'int':
+            return rng.randint(low, high)
+    raise ValueError(f"Unsupported search space entry: {spec!r}")
+
+
+def random_configs(space, num_trials, seed):
+    rng = random.Random(seed)
+    return [{name: sample_value(space[name], rng) for name in sorted(space)} for _ in range(num_trials)]
+
+
+def rung_iters(min_iters, max_iters, eta):
+    # Training budgets of the successive halving rungs: min_iters, then eta
+    # times more at every rung, ending at max_iters.
+    rungs = [min_iters]
+    while rungs[-1] * eta < max_iters:
+        rungs.append(rungs[-1] * eta)
+    if rungs[-1] < max_iters:
+        rungs.append(max_iters)
+    return rungs
+
+
+def cpu_groups(workers):
+    # Splits the CPUs this process may use into one disjoint group per worker.
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    if workers > len(cpus):
+        raise ValueError(f"{workers} workers need at least as many CPUs, only {len(cpus)} are available")
+    size = len(cpus) // workers
+    return [cpus[i * size:(i + 1) * size] for i in range(workers)]
+
+
+def latest_metadata(directory):
+    found = []
+    for name in os.listdir(directory):
+        match = METADATA_PATTERN.match(name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(directory, name)))
+    return max(found)[1] if found else None
+
+
+class Sweep:
+    # Runs every trial as its own train.py process, pinned to a group of CPUs,
+    # with the trial's settings passed through TRAIN_OVERRIDES. A rung trains
+    # the surviving trials up to its budget, resuming each from the
+    # checkpoint its previous rung ended on, and keeps the best 1/eta of them
+    # by final val loss.
+    def __init__(self, configs, output_dir, workers, min_iters, max_iters, eta):
+        self.output_dir = output_dir
+        self.rungs = rung_iters(min_iters, max_iters, eta)
+        self.eta = eta
+        self.groups = queue.Queue()
+        for group in cpu_groups(workers):
+            self.groups.put(group)
+        self.workers = workers
+        self.trials = []
+        for i, config in enumerate(configs):
+            directory = os.path.join(output_dir, f"trial_{i:03d}")
+            os.makedirs(directory, exist_ok=True)
+            self.trials.append({'trial': i, 'config': config, 'dir': directory, 'iters': 0,
+                                'status': 'running', 'results': []})
+
+    def run_trial(self, trial, iters):
+        # A rung always ends on a checkpoint: checkpoint_interval is the first
+        # rung's budget and every later budget is a multiple of it.
+        overrides = dict(trial['config'], max_iters=iters, checkpoint_interval=self.rungs[0],
+                         checkpoint_dir=os.path.join(trial['dir'], 'checkpoints'), output_dir=trial['dir'])
+        cpus = self.groups.get()
+        try:
+            env = dict(os.environ, TRAIN_OVERRIDES=json.dumps(overrides), MPLBACKEND='Agg',
+                       OMP_NUM_THREADS=str(len(cpus)))
+            for name in ('WORLD_SIZE', 'RANK', 'LOCAL_RANK', 'MASTER_ADDR', 'MASTER_PORT'):
+                env.pop(name, None)
+            command = [sys.executable, train_script] + (['--resume'] if trial['iters'] else [])
+            start = time.time()
+            with open(os.path.join(trial['dir'], 'train.log'), 'a') as log:
+                process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+                # Pinned after launch, since preexec_fn is unsafe while the
+                # pool's threads run. The child is still starting Python at
+                # this point, so the threads torch creates later inherit it.
+                if hasattr(os, 'sched_setaffinity'):
+                    try:
+                        os.sched_setaffinity(process.pid, cpus)
+                    except ProcessLookupError:
+                        pass
+                returncode = process.wait()
+            seconds = time.time() - start
+        finally:
+            self.groups.put(cpus)
+
+        if returncode != 0:
+            trial['status'] = 'failed'
+            print(f"trial {trial['trial']} failed at {iters} iterations, see {trial['dir']}/train.log")
+            return
+        metadata_file = latest_metadata(trial['dir'])
+        with open(metadata_file, 'r') as file:
+            val_loss = json.load(file)['final_losses']['val_loss']
+        trial['iters'] = iters
+        trial['results'].append({'iters': iters, 'val_loss': val_loss, 'seconds': seconds,
+                                 'metadata_file': metadata_file})
+        print(f"trial {trial['trial']} {trial['config']}: val loss {val_loss:.4f} after {iters} iterations")
+
+    def run(self):
+        with ThreadPoolExecutor(self.workers) as pool:
+            for rung, iters in enumerate(self.rungs):
+                running = [trial for trial in self.trials if trial['status'] == 'running']
+                print(f"rung {rung}: {len(running)} trials to {iters} iterations")
+                list(pool.map(lambda trial: self.run_trial(trial, iters), running))
+                finished = [trial for trial in running if trial['status'] == 'running']
+                finished.sort(key=lambda trial: trial['results'][-1]['val_loss'])
+                if rung == len(self.rungs) - 1:
+                    for trial in finished:
+                        trial['status'] = 'completed'
+                else:
+                    for trial in finished[max(1, len(finished) // self.eta):]:
+                        trial['status'] = 'pruned'
+                self.save()
+        return self.best()
+
+    def best(self):
+        completed = [trial for trial in self.trials if trial['status'] == 'completed']
+        return min(completed, key=lambda trial: trial['results'][-1]['val_loss']) if completed else None
+
+    def save(self):
+        best = self.best()
+        summary = {
+            'rungs': self.rungs,
+            'eta': self.eta,
+            'best_trial': None if best is None else best['trial'],
+            'trials': self.trials,
+        }
+        with open(os.path.join(self.output_dir, 'sweep.json'), 'w') as file:
+            json.dump(summary, file, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search train.py settings with successive halving.')
+    parser.add_argument('space', help='JSON file with the search space')
+    parser.add_argument('--search', choices=['grid', 'random'], default='grid')
+    parser.add_argument('--trials', type=int, default=16, help='number of configs for a random search')
+    parser.add_argument('--seed', type=int, default=1337)
+    parser.add_argument('--workers', type=int, default=2, help='trials trained at the same time')
+    parser.add_argument('--min-iters', type=int, default=500, help='budget of the first rung')
+    parser.add_argument('--max-iters', type=int, default=10000, help='budget of the last rung')
+    parser.add_argument('--eta', type=int, default=3, help='each rung keeps the best 1/eta of the trials')
+    parser.add_argument('--output-dir', default='sweep')
+    args = parser.parse_args()
+    if args.max_iters % args.min_iters:
+        parser.error('--max-iters must be a multiple of --min-iters')
+
+    with open(args.space, 'r') as file:
+        space = json.load(file)
+    if args.search == 'grid':
+        configs = grid_configs(space)
+    else:
+        configs = random_configs(space, args.trials, args.seed)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    best = Sweep(configs, args.output_dir, args.workers, args.min_iters, args.max_iters, args.eta).run()
+    if best is None:
+        print('No trial completed')
+    else:
+        print(f"Best trial {best['trial']}: {best['config']}, val loss {best['results'][-1]['val_loss']:.4f}")
+    print(f"Results saved as {os.path.join(args.output_dir, 'sweep.json')}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import json
+import queue
+import threading
+import time
+
+import torch
+
+
+class PhaseTimer:
+    # Marks the boundaries between the phases of a training step. On CUDA
+    # every mark is an event, so timing a phase never waits for the GPU; the
+    # durations are read by the metrics writer thread once the events are done.
+    def __init__(self, device):
+        self.cuda = str(device).startswith('cuda')
+        self.marks = []
+
+    def mark(self, name):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            self.marks.append((name, event))
+        else:
+            self.marks.append((name, time.perf_counter()))
+
+    def take(self):
+        marks, self.marks = self.marks, []
+        return marks
+
+
+def phase_seconds(marks):
+    # Seconds per phase, where a phase is named by the mark that ends it.
+    # Phases that repeat within a step, like the forward pass of every
+    # micro-batch, are added up.
+    phases = {}
+    for (_, start), (name, end) in zip(marks, marks[1:]):
+        if isinstance(end, float):
+            seconds = end - start
+        else:
+            end.synchronize()
+            seconds = start.elapsed_time(end) / 1000
+        phases[name] = phases.get(name, 0.0) + seconds
+    return phases
+
+
+class MetricsRecorder:
+    # Collects records in memory and hands every flush_every of them to a
+    # writer thread that appends them to a JSONL file, so the training loop
+    # never waits on the disk. A record's 'phases' marks are turned into
+    # seconds per phase, and their sum into step_seconds, as it is written.
+    def __init__(self, path, append=False, flush_every=100):
+        self.path = path
+        self.flush_every = flush_every
+        self.buffer = []
+        self.pending = queue.Queue()
+        self.file = open(path, 'a' if append else 'w')
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def record(self, kind, **fields):
+        fields['kind'] = kind
+        fields['time'] = time.time()
+        self.buffer.append(fields)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.pending.put(self.buffer)
+            self.buffer = []
+
+    def _write(self):
+        for records in iter(self.pending.get, None):
+            for record in records:
+                if 'phases' in record:
+                    record['phases'] = phase_seconds(record['phases'])
+                    record['step_seconds'] = sum(record['phases'].values())
+                self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.pending.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+def read_metrics(path):
+    with open(path, 'r') as file:
+        return [json.loads(line) for line in file]
+
+
+def summarize(records):
+    # Throughput, step time percentiles, data wait, the share of step time in
+    # each phase, and the memory high-water mark over the step records.
+    steps = [record for record in records if record['kind'] == 'step']
+    if not steps:
+        return None
+    times = sorted(record['step_seconds'] for record in steps)
+    total = sum(times)
+
+    def percentile(p):
+        return times[min(len(times) - 1, int(p / 100 * len(times)))]
+
+    phases = {}
+    for record in steps:
+        for name, seconds in record['phases'].items():
+            phases[name] = phases.get(name, 0.0) + seconds
+    memory = [record['peak_memory_bytes'] for record in records if record.get('peak_memory_bytes') is not None]
+    return {
+        'steps': len(steps),
+        'tokens_per_sec': sum(record['tokens'] for record in steps) / total,
+        'step_seconds': {'mean': total / len(times), 'p50': percentile(50), 'p90': percentile(90),
+                         'p99': percentile(99), 'max': times[-1]},
+        'data_wait_fraction': sum(record['data_wait'] for record in steps) / total,
+        'phase_fractions': {name: seconds / total for name, seconds in phases.items()},
+        'peak_memory_bytes': max(memory) if memory else None,
+    }
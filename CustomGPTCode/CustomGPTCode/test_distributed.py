@@ -0,0 +1,103 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from batch_loader import BatchLoader
+from tokenization import write_token_cache
+
+# Runs data-parallel training in two local gloo processes: train.py itself
+# under torchrun, training, checkpointing and resuming a tiny model, and the
+# pieces it builds on, rank-striped sampling and two ranks writing the same
+# token cache at once.
+train_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+WORLD_SIZE = 2
+VOCAB_SIZE = 32
+BLOCK_SIZE = 8
+BATCH_SIZE = 16
+TOKENS = 4096
+
+
+def check_stripes(rank):
+    # Window i of arange data starts with the value i, so the first column of
+    # a batch shows which windows the rank drew.
+    data = torch.arange(TOKENS, dtype=torch.int32)
+    loader = BatchLoader(data, BATCH_SIZE, BLOCK_SIZE, 'cpu', seed=1337, rank=rank, world_size=WORLD_SIZE)
+    starts = torch.cat([loader.next()[0][:, 0] for _ in range(20)])
+    assert loader.low <= int(starts.min()) and int(starts.max()) < loader.high, 'batch outside the rank stripe'
+    stripes = [None] * WORLD_SIZE
+    dist.all_gather_object(stripes, (loader.low, loader.high))
+    assert stripes[0][0] == 0 and stripes[-1][1] == loader.total, 'stripes do not cover the data'
+    for (_, high), (low, _) in zip(stripes, stripes[1:]):
+        assert high == low, 'stripes overlap or leave a gap'
+
+
+def check_token_cache(rank, cache_path):
+    dist.barrier()
+    for _ in range(20):
+        write_token_cache(cache_path, 'h', range(1000))
+    dist.barrier()
+    assert os.path.getsize(cache_path) == 2000, 'token cache has the wrong size'
+    assert os.listdir(os.path.dirname(cache_path)) == [os.path.basename(cache_path)], 'temporary files left behind'
+
+
+def run_rank(rank, init_file, cache_path):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=WORLD_SIZE)
+    try:
+        check_stripes(rank)
+        check_token_cache(rank, cache_path)
+    finally:
+        dist.destroy_process_group()
+
+
+def run_train_script(directory, *args):
+    overrides = {'dataset_file': 'data.txt', 'batch_size': 4, 'block_size': BLOCK_SIZE, 'n_embd': 32, 'n_head': 2,
+                 'n_layer': 2, 'max_iters': 20, 'eval_interval': 10, 'eval_iters': 2, 'checkpoint_interval': 10,
+                 'grad_accum_steps': 2}
+    env = dict(os.environ, TRAIN_OVERRIDES=json.dumps(overrides), MPLBACKEND='Agg', OMP_NUM_THREADS='1')
+    command = [sys.executable, '-m', 'torch.distributed.run', '--standalone', f'--nproc_per_node={WORLD_SIZE}',
+               train_script, *args]
+    return subprocess.run(command, cwd=directory, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+
+class DistributedTrainingTest(unittest.TestCase):
+    def test_two_gloo_ranks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            mp.spawn(run_rank, args=(os.path.join(directory, 'init'), os.path.join(directory, 'cache', 'tokens.bin')),
+                     nprocs=WORLD_SIZE)
+
+    def test_train_script_under_torchrun(self):
+        rng = random.Random(0)
+        words = [f"w{i}" for i in range(VOCAB_SIZE)]
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'data.txt'), 'w', encoding='utf-8') as file:
+                for _ in range(200):
+                    file.write(' '.join(rng.choice(words) for _ in range(20)) + '\n')
+
+            result = run_train_script(directory)
+            self.assertEqual(result.returncode, 0, result.stdout)
+            # Rank 0 alone builds the token cache and saves the model.
+            self.assertEqual(len(os.listdir(os.path.join(directory, 'token_cache'))), 1)
+            self.assertTrue(os.path.exists(os.path.join(directory, 'model_state_dict_v1.pth')))
+            self.assertFalse(os.path.exists(os.path.join(directory, 'model_state_dict_v2.pth')))
+            # A checkpoint carries the RNG state of every rank.
+            checkpoint = torch.load(os.path.join(directory, 'checkpoints', 'checkpoint_00000010.pt'), weights_only=True)
+            self.assertEqual(len(checkpoint['rng']), WORLD_SIZE)
+            self.assertEqual(checkpoint['loaders']['train']['batches'], 10 * 2)
+            self.assertEqual(checkpoint['hyperparameters']['world_size'], WORLD_SIZE)
+
+            result = run_train_script(directory, '--resume', os.path.join('checkpoints', 'checkpoint_00000010.pt'))
+            self.assertEqual(result.returncode, 0, result.stdout)
+            self.assertIn('Resuming from', result.stdout)
+            self.assertTrue(os.path.exists(os.path.join(directory, 'model_state_dict_v2.pth')))
+
+
+if __name__ == '__main__':
+    unittest.main()
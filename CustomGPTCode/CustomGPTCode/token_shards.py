@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+from array import array
+
+import torch
+
+from tokenization import Tokenizer, file_digest
+from word_tokenization import WordTokenizer
+
+# A sharded token dataset is a directory of flat int16/int32 shard files plus
+# an index.json that lists every shard with its token count and split. The
+# split is fixed per shard when the dataset is written: every val_every-th
+# shard is held out for validation.
+SHARDS_VERSION = 1
+
+
+def write_shards(chunks, output_dir, vocab_size, tokenizer_config, shard_tokens=1 << 24, val_every=10):
+    # chunks is any iterable of id sequences, e.g. Tokenizer.iter_encode_file,
+    # so the corpus never has to be in memory at once.
+    typecode = 'h' if vocab_size <= 2 ** 15 else 'i'
+    os.makedirs(output_dir, exist_ok=True)
+    shards = []
+
+    def flush(ids):
+        file_name = f"shard_{len(shards):05d}.bin"
+        with open(os.path.join(output_dir, file_name), 'wb') as file:
+            ids.tofile(file)
+        split = 'val' if len(shards) % val_every == val_every - 1 else 'train'
+        shards.append({'file': file_name, 'tokens': len(ids), 'split': split})
+
+    buffer = array(typecode)
+    for chunk in chunks:
+        # Tokenizers yield their own typecode (unsigned 'H'/'I' arrays, or
+        # int32 numpy arrays), which array.extend does not accept.
+        if hasattr(chunk, 'astype'):
+            buffer.frombytes(chunk.astype('int16' if typecode == 'h' else 'int32').tobytes())
+        else:
+            buffer.extend(array(typecode, chunk))
+        while len(buffer) >= shard_tokens:
+            flush(buffer[:shard_tokens])
+            buffer = buffer[shard_tokens:]
+    if buffer:
+        flush(buffer)
+    if len(shards) >= 2 and not any(shard['split'] == 'val' for shard in shards):
+        shards[-1]['split'] = 'val'
+
+    index = {
+        'version': SHARDS_VERSION,
+        'typecode': typecode,
+        'vocab_size': vocab_size,
+        'tokenizer': tokenizer_config,
+        'shards': shards,
+    }
+    with open(os.path.join(output_dir, 'index.json'), 'w') as file:
+        json.dump(index, file, indent=4)
+    return index
+
+
+def read_shard_index(shards_dir):
+    with open(os.path.join(shards_dir, 'index.json'), 'r') as file:
+        index = json.load(file)
+    if index['version'] != SHARDS_VERSION:
+        raise ValueError(f"Unsupported shard index version {index['version']} in {shards_dir}")
+    return index
+
+
+def load_shards(shards_dir, tokenizer_config):
+    # Maps every shard read-only into a tensor and returns the train and val
+    # shard lists, which BatchLoader samples windows across. The shards must
+    # have been encoded with the tokenizer identified by tokenizer_config.
+    index = read_shard_index(shards_dir)
+    if index['tokenizer'] != tokenizer_config:
+        raise ValueError(f"{shards_dir} was encoded with tokenizer {index['tokenizer']}, not {tokenizer_config}")
+    dtype = torch.int16 if index['typecode'] == 'h' else torch.int32
+    splits = {'train': [], 'val': []}
+    for shard in index['shards']:
+        file_path = os.path.join(shards_dir, shard['file'])
+        splits[shard['split']].append(torch.from_file(file_path, shared=False, size=shard['tokens'], dtype=dtype))
+    for split, shards in splits.items():
+        if not shards:
+            raise ValueError(f"{shards_dir} has no {split} shards; write it with a smaller shard size")
+    return splits['train'], splits['val']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Encode a dataset into memory-mapped token shards.')
+    parser.add_argument('dataset_file')
+    parser.add_argument('output_dir')
+    tokenizer_group = parser.add_mutually_exclusive_group(required=True)
+    tokenizer_group.add_argument('--merges', help='BPE merges file')
+    tokenizer_group.add_argument('--word-vocab', help='vocabulary saved by WordTokenizer.save_vocab')
+    parser.add_argument('--vocab-size', type=int, help='BPE vocabulary size')
+    parser.add_argument('--shard-tokens', type=int, default=1 << 24)
+    parser.add_argument('--val-every', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.merges is not None:
+        if args.vocab_size is None:
+            parser.error('--vocab-size is required with --merges')
+        tokenizer = Tokenizer(args.vocab_size)
+        tokenizer.load_merges(args.merges)
+        tokenizer_config = 'bpe:' + file_digest(args.merges)
+    else:
+        tokenizer = WordTokenizer()
+        tokenizer.load_vocab(args.word_vocab)
+        tokenizer_config = tokenizer.config()
+    index = write_shards(tokenizer.iter_encode_file(args.dataset_file), args.output_dir, tokenizer.vocab_size,
+                         tokenizer_config, args.shard_tokens, args.val_every)
+    print(f"Wrote {len(index['shards'])} shards to {args.output_dir}")
@@ -1,13 +1,202 @@
 # tokenization.py
+import codecs
+import functools
+import hashlib
+import heapq
 import json
+import mmap
+import multiprocessing
+import os
+import re
+import struct
+import sys
+import tempfile
+from array import array
+
+# Binary merges file: header, then (p0, p1, idx) uint32 triples, then the
+# vocab as uint32 offsets into a blob of token bytes. All little-endian.
+MERGES_MAGIC = b"BPEM"
+MERGES_VERSION = 1
+_MERGES_HEADER = struct.Struct("<4sIII")
+
+
+# Pre-tokenization for word-level BPE training: runs of word characters
+# (every byte >= 0x80 counts as one, so æ, ø and å stay inside words) and runs
+# of punctuation, each with an optional leading space, and runs of whitespace.
+WORD_PATTERN = re.compile(rb" ?[\w\x80-\xff]+| ?[^\w\s\x80-\xff]+|\s+")
+
+
+class _PairIndex:
+    # Incremental pair statistics for BPE training. Tokens live in a doubly
+    # linked list over their original positions, so a merge only touches the
+    # neighbours of each occurrence instead of the whole corpus. Pairs are
+    # ranked by (count, first position), which is exactly how
+    # max(get_accurances_of_pairs(...)) breaks ties.
+    #
+    # All per-position state is kept in typed arrays. A pair only ever gains
+    # positions during the merge that creates its newest token, and it gains
+    # them left to right, so each pair's positions stay sorted and can be
+    # consumed with a cursor instead of a heap.
+    #
+    # The list may be cut into separate sequences (-1 links) that each stand
+    # for weights[i] occurrences, which is how word-level training counts
+    # every unique word once.
+    def __init__(self, tokens, vocab_size, prev=None, nxt=None, weights=None):
+        n = len(tokens)
+        index_type = 'i' if n < 2 ** 31 else 'q'
+        self.index_type = index_type
+        self.tok = array('H' if vocab_size <= 2 ** 16 else 'I', tokens)
+        if prev is None:
+            prev = array(index_type, range(-1, n - 1))
+            nxt = array(index_type, range(1, n + 1))
+            if n:
+                nxt[-1] = -1
+        self.prev = prev
+        self.next = nxt
+        self.weights = weights
+        self.length = n if weights is None else sum(weights)
+        self.counts = {}
+        self.positions = {}
+        self.cursors = {}
+        tok = self.tok
+        for i in range(n - 1):
+            if nxt[i] == -1:
+                continue
+            pair = (tok[i], tok[i + 1])
+            weight = 1 if weights is None else weights[i]
+            if pair in self.counts:
+                self.counts[pair] += weight
+                self.positions[pair].append(i)
+            else:
+                self.counts[pair] = weight
+                self.positions[pair] = array(index_type, (i,))
+                self.cursors[pair] = 0
+        self.heap = [(-count, self.positions[pair][0], pair) for pair, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    @classmethod
+    def from_words(cls, word_counts, vocab_size):
+        tokens = array('B')
+        weights = array('q')
+        for word, count in word_counts.items():
+            tokens.frombytes(word)
+            weights.extend([count] * len(word))
+        n = len(tokens)
+        index_type = 'i' if n < 2 ** 31 else 'q'
+        prev = array(index_type, range(-1, n - 1))
+        nxt = array(index_type, range(1, n + 1))
+        start = 0
+        for word in word_counts:
+            prev[start] = -1
+            start += len(word)
+            nxt[start - 1] = -1
+        return cls(tokens, vocab_size, prev, nxt, weights)
+
+    def _at(self, i, pair):
+        # Removed nodes have next == -1, so they never match.
+        j = self.next[i]
+        return j != -1 and self.tok[i] == pair[0] and self.tok[j] == pair[1]
+
+    def _first_position(self, pair):
+        positions = self.positions[pair]
+        cursor = self.cursors[pair]
+        while not self._at(positions[cursor], pair):
+            cursor += 1
+        self.cursors[pair] = cursor
+        return positions[cursor]
+
+    def _add(self, pair, i, weight):
+        if pair in self.positions:
+            self.counts[pair] += weight
+            self.positions[pair].append(i)
+        else:
+            self.counts[pair] = weight
+            self.positions[pair] = array(self.index_type, (i,))
+            self.cursors[pair] = 0
+
+    def _remove(self, pair, weight):
+        self.counts[pair] -= weight
+
+    def best_pair(self):
+        while self.heap:
+            neg_count, first, pair = self.heap[0]
+            count = self.counts.get(pair, 0)
+            if count == 0:
+                heapq.heappop(self.heap)
+                continue
+            current = self._first_position(pair)
+            if count == -neg_count and current == first:
+                return pair
+            heapq.heapreplace(self.heap, (-count, current, pair))
+        return None
+
+    def merge(self, pair, idx):
+        tok, prev, nxt, weights = self.tok, self.prev, self.next, self.weights
+        positions = self.positions.pop(pair)
+        cursor = self.cursors.pop(pair)
+        added = set()
+        for i in positions[cursor:]:
+            if not self._at(i, pair):
+                continue
+            weight = 1 if weights is None else weights[i]
+            j = nxt[i]
+            p = prev[i]
+            k = nxt[j]
+            if p != -1:
+                self._remove((tok[p], tok[i]), weight)
+            if k != -1:
+                self._remove((tok[j], tok[k]), weight)
+            tok[i] = idx
+            nxt[i] = k
+            if k != -1:
+                prev[k] = i
+            prev[j] = nxt[j] = -1
+            self.length -= weight
+            if p != -1:
+                self._add((tok[p], idx), p, weight)
+                added.add((tok[p], idx))
+            if k != -1:
+                self._add((idx, tok[k]), i, weight)
+                added.add((idx, tok[k]))
+        del self.counts[pair]
+        for new_pair in added:
+            count = self.counts[new_pair]
+            if count:
+                heapq.heappush(self.heap, (-count, self._first_position(new_pair), new_pair))
+
+
+class StreamingDecoder:
+    # Decodes one id at a time. Bytes of a multi-byte character that is split
+    # across tokens (æ, ø, å) are held back until the character is complete.
+    def __init__(self, vocab):
+        self.vocab = vocab
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def step(self, idx):
+        return self._decoder.decode(self.vocab[idx])
+
+    def flush(self):
+        return self._decoder.decode(b"", final=True)
+
+    def reset(self):
+        self._decoder.reset()
+
 
 class Tokenizer:
-    def __init__(self, vocab_size):
+    def __init__(self, vocab_size, encode_cache_size=2 ** 16):
         self.vocab_size = vocab_size
         self.merges = {}
         self.vocab = {idx: bytes([idx]) for idx in range(256)}
+        self.encode_cache_size = encode_cache_size
+        self._reset_encode_cache()
 
-    def load_text(self, file_path):
+    def load_text(self, file_path, stream=False):
+        if stream:
+            # The raw bytes are already the initial tokens, so map the file
+            # instead of copying it into a list of ints.
+            with open(file_path, 'rb') as file:
+                self.tokens = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+            return
         with open(file_path, 'r', encoding='utf-8') as file:
             text = file.read()
         tokens = text.encode('utf-8')
@@ -33,59 +222,301 @@ class Tokenizer:
                 new_tokens.append(tokens[i])
                 i += 1
         return new_tokens
-    def tokenize(self):
+    def truncated(self, vocab_size):
+        # BPE merges form a prefix-ordered list, so the tokenizer for a smaller
+        # vocabulary is the first vocab_size - 256 merges of a larger run.
+        tokenizer = Tokenizer(vocab_size, self.encode_cache_size)
+        tokenizer._set_merges({pair: idx for pair, idx in self.merges.items() if idx < vocab_size})
+        return tokenizer
+
+    def count_words(self):
+        data = bytes(self.tokens) if isinstance(self.tokens, list) else self.tokens
+        word_counts = {}
+        for match in WORD_PATTERN.finditer(data):
+            word = match.group()
+            word_counts[word] = word_counts.get(word, 0) + 1
+        return word_counts
+
+    def tokenize(self, by_words=False):
+        # With by_words, the corpus is split with WORD_PATTERN and BPE runs
+        # over the unique words weighted by their counts, so merges never
+        # cross a word boundary. Ties go to the pair that appears first when
+        # the unique words are laid out in order of first occurrence.
         num_merges = self.vocab_size - 256
-        copy_tokens = list(self.tokens)
-        #stats = {}
+        if by_words:
+            index = _PairIndex.from_words(self.count_words(), self.vocab_size)
+        else:
+            index = _PairIndex(self.tokens, self.vocab_size)
         for i in range(num_merges):
-
-            stats = self.get_accurances_of_pairs(copy_tokens)
-            pair = max(stats, key=stats.get)
+            pair = index.best_pair()
+            if pair is None:
+                break
 
             idx = 256 + i
             print(f"merging {pair} into a new token {idx}")
-            copy_tokens = self.merge_pair_into_tokens(copy_tokens, pair, idx)
+            index.merge(pair, idx)
             self.merges[pair] = idx
 
-        for (p0, p1), idx in self.merges.items():
-            self.vocab[idx] = self.vocab[p0] + self.vocab[p1]
+        self._set_merges(self.merges)
 
         print("tokens length:", len(self.tokens))
-        print("ids length:", len(copy_tokens))
-        print(f"compression ratio: {len(self.tokens) / len(copy_tokens):.2f}X")
+        print("ids length:", index.length)
+        print(f"compression ratio: {len(self.tokens) / index.length:.2f}X")
 
     def save_merges(self, file_path):
+        if not file_path.endswith('.json'):
+            self._save_merges_binary(file_path)
+            return
         with open(file_path, 'w') as file:
             json.dump({str(k): v for k, v in self.merges.items()}, file)
 
+    def _save_merges_binary(self, file_path):
+        num_tokens = max(self.vocab) + 1
+        merges = array('I')
+        for (p0, p1), idx in sorted(self.merges.items(), key=lambda item: item[1]):
+            merges.extend((p0, p1, idx))
+        offsets = array('I', [0])
+        blob = bytearray()
+        for idx in range(num_tokens):
+            blob += self.vocab.get(idx, b"")
+            offsets.append(len(blob))
+        if sys.byteorder != 'little':
+            merges.byteswap()
+            offsets.byteswap()
+        with open(file_path, 'wb') as file:
+            file.write(_MERGES_HEADER.pack(MERGES_MAGIC, MERGES_VERSION, len(self.merges), num_tokens))
+            file.write(merges.tobytes())
+            file.write(offsets.tobytes())
+            file.write(blob)
+
     def load_merges(self, file_path):
+        with open(file_path, 'rb') as file:
+            is_binary = file.read(len(MERGES_MAGIC)) == MERGES_MAGIC
+        if is_binary:
+            self._load_merges_binary(file_path)
+            return
         with open(file_path, 'r') as file:
-            self.merges = {eval(k): v for k, v in json.load(file).items()}
-        for (p0, p1), idx in self.merges.items():
-            self.vocab[idx] = self.vocab[p0] + self.vocab[p1]
+            self._set_merges({tuple(map(int, k.strip("()").split(","))): v for k, v in json.load(file).items()})
+
+    def _load_merges_binary(self, file_path):
+        with open(file_path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        with buffer:
+            magic, version, num_merges, num_tokens = _MERGES_HEADER.unpack_from(buffer)
+            if version != MERGES_VERSION:
+                raise ValueError(f"Unsupported merges file version {version} in {file_path}")
+            start = _MERGES_HEADER.size
+            merges = array('I')
+            merges.frombytes(buffer[start:start + 12 * num_merges])
+            start += 12 * num_merges
+            offsets = array('I')
+            offsets.frombytes(buffer[start:start + 4 * (num_tokens + 1)])
+            start += 4 * (num_tokens + 1)
+            if sys.byteorder != 'little':
+                merges.byteswap()
+                offsets.byteswap()
+            blob = buffer[start:start + offsets[-1]]
+        vocab = {idx: blob[offsets[idx]:offsets[idx + 1]] for idx in range(num_tokens)}
+        self._set_merges({(merges[i], merges[i + 1]): merges[i + 2] for i in range(0, len(merges), 3)}, vocab)
+
+    def _set_merges(self, merges, vocab=None):
+        self.merges = merges
+        if vocab is None:
+            for (p0, p1), idx in self.merges.items():
+                self.vocab[idx] = self.vocab[p0] + self.vocab[p1]
+        else:
+            self.vocab = vocab
+        self._reset_encode_cache()
 
     def decode(self, ids):
         tokens = b"".join(self.vocab[idx] for idx in ids)
         text = tokens.decode("utf-8", errors="replace")
         return text
 
+    def decode_stream(self, ids):
+        # Yields text as ids arrive. Joined, the pieces equal decode(ids).
+        decoder = StreamingDecoder(self.vocab)
+        for idx in ids:
+            text = decoder.step(idx)
+            if text:
+                yield text
+        text = decoder.flush()
+        if text:
+            yield text
+
+    def _reset_encode_cache(self):
+        self._encode_chunk_cached = None
+        self._boundaries = None
+
+    def _build_encode_cache(self):
+        # A boundary between two bytes is safe to split on when no merged
+        # token contains that byte pair, since then no merge can ever cross it
+        # and encoding the pieces separately gives the same ids.
+        boundaries = bytearray(b"\x01" * 65536)
+        for idx in self.merges.values():
+            token = self.vocab[idx]
+            for b0, b1 in zip(token, token[1:]):
+                boundaries[b0 << 8 | b1] = 0
+        self._boundaries = boundaries
+        self._encode_chunk_cached = functools.lru_cache(maxsize=self.encode_cache_size)(self._encode_chunk)
+
+    def _split_chunks(self, data):
+        boundaries = self._boundaries
+        start = 0
+        for i in range(1, len(data)):
+            if boundaries[data[i - 1] << 8 | data[i]]:
+                yield data[start:i]
+                start = i
+        if data:
+            yield data[start:]
+
+    def _encode_chunk(self, chunk):
+        return tuple(self._merge_by_rank(list(chunk)))
+
+    def _merge_by_rank(self, tokens):
+        # Applies merges lowest rank first and left to right within a rank,
+        # which is the order the repeated min()/merge_pair_into_tokens loop
+        # produces, but in a single pass over a linked list.
+        merges = self.merges
+        n = len(tokens)
+        if n < 2 or not merges:
+            return tokens
+        prev = list(range(-1, n - 1))
+        nxt = list(range(1, n + 1))
+        nxt[-1] = -1
+        heap = [(merges[pair], i) for i, pair in enumerate(zip(tokens, tokens[1:])) if pair in merges]
+        heapq.heapify(heap)
+        while heap:
+            idx, i = heapq.heappop(heap)
+            j = nxt[i]
+            if j == -1 or merges.get((tokens[i], tokens[j])) != idx:
+                continue
+            k = nxt[j]
+            tokens[i] = idx
+            tokens[j] = -1
+            nxt[i] = k
+            if k != -1:
+                prev[k] = i
+                rank = merges.get((idx, tokens[k]))
+                if rank is not None:
+                    heapq.heappush(heap, (rank, i))
+            p = prev[i]
+            if p != -1:
+                rank = merges.get((tokens[p], idx))
+                if rank is not None:
+                    heapq.heappush(heap, (rank, p))
+        return [token for token in tokens if token != -1]
+
     def encode(self, text):
         if isinstance(text, str):
-            tokens = list(text.encode("utf-8"))
+            data = text.encode("utf-8")
         elif isinstance(text, list):
-            tokens = text
+            try:
+                data = bytes(text)
+            except ValueError:
+                return self._merge_by_rank(list(text))
+        elif isinstance(text, (bytes, bytearray, memoryview)):
+            data = bytes(text)
         else:
-            3
             raise TypeError("Input should be a string or a list of tokens")
+        return self._encode_bytes(data)
+
+    def _encode_bytes(self, data):
+        if self._encode_chunk_cached is None:
+            self._build_encode_cache()
+        tokens = []
+        for chunk in self._split_chunks(data):
+            tokens.extend(self._encode_chunk_cached(chunk))
+        return tokens
+
+    def _last_boundary(self, data):
+        boundaries = self._boundaries
+        for i in range(len(data) - 1, 0, -1):
+            if boundaries[data[i - 1] << 8 | data[i]]:
+                return i
+        return 0
 
-        while len(tokens) >= 2:
-            stats = self.get_accurances_of_pairs(tokens)
-            pair = min(stats, key=lambda p: self.merges.get(p, float("inf")))
-            if pair not in self.merges:
+    def iter_encode_file(self, file_path, chunk_size=1 << 20):
+        # Reads fixed-size blocks and encodes everything up to the last safe
+        # boundary in each, carrying the rest over into the next block.
+        if self._boundaries is None:
+            self._build_encode_cache()
+        typecode = 'H' if self.vocab_size <= 2 ** 16 else 'I'
+        tail = b""
+        with open(file_path, 'rb') as file:
+            while True:
+                block = file.read(chunk_size)
+                if not block:
+                    break
+                data = tail + block
+                cut = self._last_boundary(data)
+                tail = data[cut:]
+                if cut:
+                    yield array(typecode, self._encode_bytes(data[:cut]))
+        if tail:
+            yield array(typecode, self._encode_bytes(tail))
+
+    def encode_to_array(self, file_path, chunk_size=1 << 20):
+        ids = array('H' if self.vocab_size <= 2 ** 16 else 'I')
+        for chunk in self.iter_encode_file(file_path, chunk_size):
+            ids.extend(chunk)
+        return ids
+
+    def _split_lines(self, data, chunk_size):
+        # Cuts data after a newline, but only where no merge can cross the
+        # cut, so the pieces encode independently to the same ids.
+        if self._boundaries is None:
+            self._build_encode_cache()
+        boundaries = self._boundaries
+        start = 0
+        while len(data) - start > chunk_size:
+            i = data.find(b"\n", start + chunk_size) + 1
+            while 0 < i < len(data) and not boundaries[data[i - 1] << 8 | data[i]]:
+                i = data.find(b"\n", i) + 1
+            if not 0 < i < len(data):
                 break
-            idx = self.merges[pair]
-            tokens = self.merge_pair_into_tokens(tokens, pair, idx)
+            yield data[start:i]
+            start = i
+        yield data[start:]
+
+    def _encode_parallel(self, pieces, workers):
+        if workers <= 1 or len(pieces) <= 1:
+            return [self._encode_bytes(piece) for piece in pieces]
+        chunksize = max(1, len(pieces) // (workers * 4))
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(self.vocab_size, self.merges)) as pool:
+            return [ids.tolist() for ids in pool.imap(_encode_in_worker, pieces, chunksize)]
+
+    def encode_batch(self, texts, workers=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        return self._encode_parallel([text.encode("utf-8") for text in texts], workers)
+
+    def encode_file(self, file_path, workers=None, chunk_size=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        with open(file_path, 'r', encoding='utf-8') as file:
+            data = file.read().encode('utf-8')
+        if chunk_size is None:
+            chunk_size = max(1 << 16, len(data) // (workers * 4))
+        tokens = []
+        for ids in self._encode_parallel(list(self._split_lines(data, chunk_size)), workers):
+            tokens.extend(ids)
         return tokens
+
+
+_worker_tokenizer = None
+
+
+def _init_worker(vocab_size, merges):
+    # Runs once per pool process, so the merges table is pickled once per
+    # worker rather than once per task.
+    global _worker_tokenizer
+    _worker_tokenizer = Tokenizer(vocab_size)
+    _worker_tokenizer._set_merges(merges)
+
+
+def _encode_in_worker(data):
+    return array('I', _worker_tokenizer._encode_bytes(data))
 """
 import os
 
@@ -99,3 +530,47 @@ if not os.path.exists(merges_file):
 else:
     tokenizer.load_merges(merges_file)
 """
+
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def token_cache_path(cache_dir, dataset_file, tokenizer_config, vocab_size):
+    # Encoded corpora are cached as flat int16/int32 files keyed by the
+    # dataset contents and the tokenizer configuration.
+    typecode = 'h' if vocab_size <= 2 ** 15 else 'i'
+    key = hashlib.sha256(f"{file_digest(dataset_file)}:{tokenizer_config}:{typecode}".encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.basename(dataset_file)}_{key}.bin"), typecode
+
+
+def write_token_cache(cache_path, typecode, ids):
+    # Every writer gets its own temporary file, so processes that build the
+    # same cache at once (parallel sweep trials) each rename a complete file
+    # into place and readers never see a partial one.
+    ids = array(typecode, ids)
+    cache_dir = os.path.dirname(cache_path) or '.'
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=os.path.basename(cache_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            ids.tofile(file)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def convert_merges(source_path, target_path):
+    tokenizer = Tokenizer(256)
+    tokenizer.load_merges(source_path)
+    tokenizer.save_merges(target_path)
+
+
+if __name__ == "__main__":
+    # python tokenization.py merge_dataset_10_2000.json merge_dataset_10_2000.bpe
+    convert_merges(sys.argv[1], sys.argv[2])
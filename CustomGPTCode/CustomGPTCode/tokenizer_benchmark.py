@@ -0,0 +1,132 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+
+from tokenization import Tokenizer
+
+datasets_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Datasets')
+default_datasets = [os.path.join(datasets_dir, 'dataset_3.txt'), os.path.join(datasets_dir, 'dataset_6.txt')]
+
+
+def make_synthetic_corpus(source_files, scale, seed, directory):
+    # Scaled-up corpora are built by sampling whole lines of the real datasets
+    # with a fixed seed, so the text statistics stay realistic and every run
+    # benchmarks the same bytes.
+    lines = []
+    for file_path in source_files:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            lines.extend(file.read().splitlines(keepends=True))
+    target = scale * sum(os.path.getsize(file_path) for file_path in source_files)
+    rng = random.Random(seed)
+    file_path = os.path.join(directory, f"synthetic_x{scale}.txt")
+    size = 0
+    with open(file_path, 'w', encoding='utf-8') as file:
+        while size < target:
+            line = rng.choice(lines)
+            file.write(line)
+            size += len(line.encode('utf-8'))
+    return file_path
+
+
+def train(file_path, vocab_size):
+    tokenizer = Tokenizer(vocab_size)
+    tokenizer.load_text(file_path)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        tokenizer.tokenize()
+        elapsed = time.perf_counter() - start
+    return tokenizer, elapsed
+
+
+def peak_training_memory(file_path, vocab_size):
+    tracemalloc.start()
+    try:
+        train(file_path, vocab_size)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_corpus(file_path, vocab_sizes, measure_memory):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        text = file.read()
+    num_bytes = len(text.encode('utf-8'))
+    tokenizer, train_seconds = train(file_path, max(vocab_sizes))
+    results = []
+    for vocab_size in sorted(vocab_sizes):
+        sized = tokenizer.truncated(vocab_size)
+
+        start = time.perf_counter()
+        ids = sized.encode(text)
+        encode_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sized.decode(ids)
+        decode_seconds = time.perf_counter() - start
+
+        results.append({
+            'corpus': os.path.basename(file_path),
+            'corpus_bytes': num_bytes,
+            'vocab_size': vocab_size,
+            'num_tokens': len(ids),
+            'compression_ratio': num_bytes / max(len(ids), 1),
+            'encode_mb_per_s': num_bytes / 1e6 / encode_seconds,
+            'decode_mb_per_s': num_bytes / 1e6 / decode_seconds,
+        })
+    num_merges = len(tokenizer.merges)
+    training = {
+        'corpus': os.path.basename(file_path),
+        'corpus_bytes': num_bytes,
+        'vocab_size': max(vocab_sizes),
+        'train_seconds': train_seconds,
+        'merges_per_s': num_merges / train_seconds if train_seconds else None,
+        'peak_memory_bytes': peak_training_memory(file_path, max(vocab_sizes)) if measure_memory else None,
+    }
+    return training, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark BPE training, encoding and decoding throughput.')
+    parser.add_argument('--datasets', nargs='+', default=default_datasets)
+    parser.add_argument('--vocab-sizes', nargs='+', type=int, default=[512, 1024, 2048])
+    parser.add_argument('--scales', nargs='*', type=int, default=[4],
+                        help='sizes of synthetic corpora as multiples of the combined datasets')
+    parser.add_argument('--seed', type=int, default=1337)
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced peak-memory training run')
+    parser.add_argument('--output', default='tokenizer_benchmark.json')
+    args = parser.parse_args()
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'vocab_sizes': sorted(args.vocab_sizes),
+        'training': [],
+        'results': [],
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        corpora = list(args.datasets)
+        corpora += [make_synthetic_corpus(args.datasets, scale, args.seed, directory) for scale in args.scales]
+        for file_path in corpora:
+            print(f"benchmarking {os.path.basename(file_path)}")
+            training, results = benchmark_corpus(file_path, args.vocab_sizes, not args.no_memory)
+            report['training'].append(training)
+            report['results'].extend(results)
+            print(f"  {training['merges_per_s']:.1f} merges/s")
+            for result in results:
+                print(f"  vocab {result['vocab_size']}: {result['compression_ratio']:.2f}X, "
+                      f"encode {result['encode_mb_per_s']:.2f} MB/s, decode {result['decode_mb_per_s']:.2f} MB/s")
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=4)
+    print(f"Results saved as {args.output}")
+
+
+if __name__ == '__main__':
+    main()
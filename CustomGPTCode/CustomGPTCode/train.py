@@ -1,13 +1,25 @@
+import argparse
+import contextlib
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 import time
 import os
+import sys
 
 #from pycparser.ply.yacc import token
 from torch.nn import functional as F, Dropout
+from torch.nn.parallel import DistributedDataParallel
 import json
-
-from tokenization import Tokenizer
+import multiprocessing
+
+from tokenization import Tokenizer, file_digest, token_cache_path, write_token_cache
+from token_shards import load_shards, read_shard_index
+from batch_loader import BatchLoader
+from checkpointing import CheckpointWriter, latest_checkpoint, snapshot
+from telemetry import MetricsRecorder, PhaseTimer, read_metrics, summarize
+from profiling import Profiler
+from word_tokenization import WordTokenizer
 #from fastapi import FastAPI
 
 vocab_size = 8000
@@ -20,6 +32,14 @@ eval_interval = 500
 learning_rate = 1e-4
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 eval_iters =200
+# Evaluation scores a fixed set of eval_windows windows per split, spread
+# evenly over the data and taken once, in batches of eval_batch_size. With
+# eval_in_background a separate process scores snapshots of the model while
+# training continues.
+# None means eval_iters * batch_size windows and batches of 2 * batch_size.
+eval_windows = None
+eval_batch_size = None
+eval_in_background = False
 
 
 n_embd = 768
@@ -32,11 +52,78 @@ n_layer = 8
 
 dropout = 0.1
 
+# 'fp32', 'bf16' or 'fp16'. bf16 autocasts on CPU and GPU; fp16 needs a GPU
+# and runs with a gradient scaler. batch_size is the micro-batch, and each
+# optimizer step accumulates gradients over grad_accum_steps of them.
+precision = 'fp32'
+grad_accum_steps = 1
+
+# Activation checkpointing: every activation_checkpoint_every-th Block (1 for
+# all of them) keeps only its input during training and recomputes its
+# activations in the backward pass, trading step time for memory so deep
+# configs fit larger batches. None stores every activation.
+activation_checkpoint_every = None
+
+# Runs the training step and the generation forward through torch.compile.
+# Compiled kernels are kept in compile_cache_dir, so later runs with the same
+# shapes skip most of the compile time. If compiling fails, training and
+# generation carry on in eager mode.
+compile_model = False
+compile_cache_dir = 'compile_cache'
+
 merges_file = 'merge_dataset_10_2000.json'
 
 
 dataset_file = 'dataset_10.txt'
 
+# Word tokenization: keep at most max_vocab_size words (None keeps them all),
+# and load the vocabulary saved next to a checkpoint from vocab_file instead
+# of rebuilding it from dataset_file.
+max_vocab_size = None
+vocab_file = None
+
+token_cache_dir = 'token_cache'
+# Directory written by token_shards.py. When set, training samples from the
+# memory-mapped shards and their fixed train/val split instead of data below,
+# vocab_size comes from the shard index, and vocab_file must be the
+# vocabulary the shards were encoded with; dataset_file is not read.
+shards_dir = None
+
+# Seeds the batch sampler so the sequence of training batches can be
+# reproduced. None draws a fresh seed on every run.
+data_seed = None
+prefetch_batches = 4
+
+# Every checkpoint_interval iterations the full training state (model,
+# optimizer, RNG and sampler state, metric history) is written to
+# checkpoint_dir, keeping the newest keep_checkpoints. Run with --resume to
+# continue from the newest one. None turns checkpointing off.
+checkpoint_interval = 1000
+checkpoint_dir = 'checkpoints'
+keep_checkpoints = 3
+
+# Where the versioned model, metadata and metrics graph files are written.
+# Per-step timings and the evaluations are logged to metrics_file in it, one
+# JSON record per line, and the graph is drawn from that log.
+output_dir = './'
+metrics_file = 'metrics.jsonl'
+
+# Set from the command line with --profile; see profiling.Profiler.
+profiler = None
+
+# Any of the settings above can be overridden without editing this file, by
+# a JSON object in the TRAIN_OVERRIDES environment variable. sweep.py runs
+# its trials this way.
+overrides = json.loads(os.environ.get('TRAIN_OVERRIDES', '{}'))
+unknown = sorted(name for name in overrides if name not in globals())
+if unknown:
+    raise ValueError(f"TRAIN_OVERRIDES sets unknown settings: {', '.join(unknown)}")
+globals().update(overrides)
+if eval_windows is None:
+    eval_windows = eval_iters * batch_size
+if eval_batch_size is None:
+    eval_batch_size = 2 * batch_size
+
 #--------------
 hyperparameters = {
     'batch_size': batch_size,
@@ -46,16 +133,47 @@ hyperparameters = {
     'learning_rate': learning_rate,
     'device': device,
     'eval_iters': eval_iters,
+    'eval_windows': eval_windows,
     'n_embd': n_embd,
     'n_head': n_head,
     'n_layer': n_layer,
     'dropout': dropout,
     'vocab_size': vocab_size,
     'merges_file': merges_file,
-    'dataset_file': dataset_file
+    'dataset_file': dataset_file,
+    'precision': precision,
+    'grad_accum_steps': grad_accum_steps,
+    'compile_model': compile_model,
+    'activation_checkpoint_every': activation_checkpoint_every,
+    'world_size': 1
 }
 #torch.manual_seed(1337)
 
+# Data-parallel training: launched with torchrun, every process trains a
+# replica on its own part of the training data over the gloo backend, and
+# gradients are averaged across processes on every optimizer step. Only rank 0
+# evaluates, checkpoints and saves. On one machine:
+#   torchrun --standalone --nproc_per_node=4 train.py
+# and across hosts, on each host with its own --node_rank:
+#   torchrun --nnodes=2 --node_rank=0 --nproc_per_node=2 --master_addr=host0 --master_port=29500 train.py
+# Processes spawned by this one (the background evaluator) inherit the
+# launcher's environment but are not part of the group.
+world_size = int(os.environ.get('WORLD_SIZE', 1))
+distributed = world_size > 1 and multiprocessing.parent_process() is None
+if distributed:
+    torch.distributed.init_process_group('gloo')
+    rank = torch.distributed.get_rank()
+    if device == 'cuda':
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    # Every rank needs the same base seed to derive its own sampler stream.
+    if data_seed is None:
+        seeds = [int.from_bytes(os.urandom(8), 'little') >> 2]
+        torch.distributed.broadcast_object_list(seeds, src=0)
+        data_seed = seeds[0]
+    hyperparameters['world_size'] = world_size
+else:
+    rank, world_size = 0, 1
+
 print(device)
 start_time = time.time()
 
@@ -76,20 +194,24 @@ else:
     print('loading merges')
     tokenizer.load_merges(merges_file)
 
+decode_stream = tokenizer.decode_stream
 """
 #Word tokenization
-with open(dataset_file, 'r', encoding="utf-8") as file:
-    text = file.read()
-words = text.split()
-words = sorted(list(set(words)))
-vocab_size = len(words)
+tokenizer = WordTokenizer(max_vocab_size)
+if vocab_file is not None:
+    tokenizer.load_vocab(vocab_file)
+elif shards_dir is not None:
+    raise ValueError("Training on shards_dir needs the vocab_file its shards were encoded with")
+else:
+    tokenizer.load_text(dataset_file)
+    tokenizer.tokenize()
+vocab_size = tokenizer.vocab_size
 
 print(f"Number of unique words: {vocab_size}")
 
-stoi = { word: i for i, word in enumerate(words) }
-itos = { i: word for i, word in enumerate(words) }
-encode = lambda s: [stoi[word] for word in s.split()]
-decode = lambda l: ' '.join(itos[i] for i in l)
+encode = tokenizer.encode
+decode = tokenizer.decode
+decode_stream = tokenizer.decode_stream
 """
 #Character tokenization
 
@@ -101,92 +223,244 @@ itos = { i:ch for i,ch in enumerate(chars) }
 encode = lambda s: [stoi[ch] for ch in s]
 decode = lambda l: ''.join(itos[i] for i in l)
 """
+def load_encoded_data(dataset_file, tokenizer_config, encode_fn, vocab_size):
+    # The token cache is written once and mapped straight into a tensor on
+    # later runs. Under torchrun only rank 0 encodes, and the other ranks
+    # wait for it before mapping the file.
+    cache_path, typecode = token_cache_path(token_cache_dir, dataset_file, tokenizer_config, vocab_size)
+    if os.path.exists(cache_path):
+        print('loading encoded data')
+    elif rank == 0:
+        print('encoding data')
+        write_token_cache(cache_path, typecode, encode_fn())
+    if distributed:
+        torch.distributed.barrier()
+    dtype, itemsize = (torch.int16, 2) if typecode == 'h' else (torch.int32, 4)
+    size = os.path.getsize(cache_path) // itemsize
+    return torch.from_file(cache_path, shared=False, size=size, dtype=dtype)
+
 """
-if os.path.exists('encoded_' + dataset_file + '_'+ merges_file + '.pt'):
-    print('loading encoded data')
-    data = torch.load('encoded_' + dataset_file + '_'+ merges_file + '.pt')
-    #print(data[:100])
-else:
-    print('encoding data')
-    data = torch.tensor(tokenizer.encode(tokenizer.tokens), dtype=torch.long)
-    print('saving encoded data')
-    torch.save(data, 'encoded_' + dataset_file + '_'+ merges_file + '.pt')
+data = load_encoded_data(dataset_file, 'bpe:' + file_digest(merges_file), lambda: tokenizer.encode_to_array(dataset_file), vocab_size)
+train_data, val_data = load_shards(shards_dir, 'bpe:' + file_digest(merges_file))
 """
-data = torch.tensor(encode(text), dtype=torch.long)
-n = int(0.9*len(data))
-train_data = data[:n]
-val_data = data[n:]
-
-def get_batch(split):
-    data = train_data if split == 'train' else val_data
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([data[i:i+block_size] for i in ix])
-    y = torch.stack([data[i+1:i+block_size+1] for i in ix])
-    return x.to(device), y.to(device)
-
+if shards_dir is not None:
+    train_data, val_data = load_shards(shards_dir, tokenizer.config())
+    vocab_size = read_shard_index(shards_dir)['vocab_size']
+else:
+    data = load_encoded_data(dataset_file, tokenizer.config(), lambda: tokenizer.encode_to_array(dataset_file), vocab_size)
+    n = int(0.9*len(data))
+    train_data = data[:n]
+    val_data = data[n:]
+
+train_loader = BatchLoader(train_data, batch_size, block_size, device, seed=data_seed, prefetch=prefetch_batches,
+                           rank=rank, world_size=world_size)
+
+def get_batch():
+    return train_loader.next()
+
+def fixed_windows(data, num_windows):
+    # num_windows (block_size + 1) windows at evenly spaced starts over data,
+    # which may be a list of shards, kept on the device in the data's dtype.
+    shards = data if isinstance(data, (list, tuple)) else [data]
+    windows = [shard.unfold(0, block_size + 1, 1) for shard in shards]
+    counts = torch.tensor([len(shard_windows) for shard_windows in windows])
+    starts = torch.cumsum(counts, 0) - counts
+    total = int(counts.sum())
+    ix = torch.linspace(0, total - 1, min(num_windows, total)).long()
+    shard_ids = torch.searchsorted(starts, ix, right=True) - 1
+    return torch.cat([windows[shard][ix[shard_ids == shard] - starts[shard]] for shard in range(len(windows))]).to(device)
+
+eval_sets = {'train': fixed_windows(train_data, eval_windows), 'val': fixed_windows(val_data, eval_windows)}
+
+
+autocast_dtype = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[precision]
+if precision == 'fp16' and device != 'cuda':
+    raise ValueError("fp16 training needs a GPU; use precision = 'bf16' on CPU")
+
+def autocast():
+    return torch.autocast(device_type=device, dtype=autocast_dtype, enabled=autocast_dtype is not None)
+
+def peak_memory_bytes():
+    if device == 'cuda':
+        return torch.cuda.max_memory_allocated()
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def synchronize():
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+def dynamo_graphs():
+    return torch._dynamo.utils.counters['stats']['unique_graphs']
+
+class CompiledFunction:
+    # Calls fn through torch.compile. A call that makes dynamo compile a new
+    # graph, whichever of its guards failed, is counted and timed as compile
+    # time; a failure switches this function to eager for good.
+    def __init__(self, fn, name):
+        self.fn = fn
+        self.name = name
+        self.compiled = None
+        self.compile_seconds = 0.0
+        self.graphs = 0
+        self.error = None
+        if not hasattr(torch, 'compile'):
+            self.error = 'torch.compile is not available in this torch version'
+            return
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(compile_cache_dir))
+        # Training, the bucketed prompt and window lengths and the cache sizes
+        # each compile their own graph of the same forward.
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+        self.compiled = torch.compile(fn, dynamic=False)
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is None:
+            return self.fn(*args, **kwargs)
+        try:
+            graphs = dynamo_graphs()
+            start = time.time()
+            out = self.compiled(*args, **kwargs)
+            if dynamo_graphs() != graphs:
+                synchronize()
+                self.compile_seconds += time.time() - start
+                self.graphs += dynamo_graphs() - graphs
+            return out
+        except Exception as error:
+            print(f"Compiling the {self.name} failed, falling back to eager: {error}")
+            self.compiled = None
+            self.error = f"{type(error).__name__}: {error}"
+            return self.fn(*args, **kwargs)
+
+    def stats(self):
+        return {'compile_seconds': self.compile_seconds, 'graphs': self.graphs, 'error': self.error}
 
 @torch.no_grad()
 def estimate_loss():
-    out = {}
+    # Loss and accuracy over the fixed eval_sets. The sums stay on the device
+    # and are read back together once at the end, instead of syncing on
+    # every batch.
     model.eval()
-    for split in ['train', 'val']:
-        losses = torch.zeros(eval_iters)
-        accuracies = torch.zeros(eval_iters)
-        for k in range(eval_iters):
-            X, Y = get_batch(split)
-            logits, loss = model(X, Y)
-            losses[k] = loss.item()
-
-            # Calculate accuracy
-            if len(logits.shape) == 2:
-                # Already flattened logits
-                preds = torch.argmax(logits, dim=-1)
-                targets = Y.reshape(-1)  # Flatten targets
-            else:
-                # Need to reshape logits
-                B, T, C = logits.shape
-                logits = logits.reshape(B * T, C)
-                preds = torch.argmax(logits, dim=-1)
-                targets = Y.reshape(B * T)
-
-            correct = (preds == targets).float().mean()
-            accuracies[k] = correct.item()
-
-        out[split + '_loss'] = losses.mean()
-        out[split + '_acc'] = accuracies.mean()
+    sums = []
+    for split, windows in eval_sets.items():
+        loss_sum = torch.zeros((), device=device)
+        correct = torch.zeros((), device=device, dtype=torch.long)
+        for start in range(0, len(windows), eval_batch_size):
+            batch = windows[start:start + eval_batch_size].long()
+            X, Y = batch[:, :-1], batch[:, 1:]
+            with autocast():
+                logits, loss = model(X)
+            loss_sum += F.cross_entropy(logits.flatten(0, 1).float(), Y.flatten(), reduction='sum')
+            correct += (logits.argmax(dim=-1) == Y).sum()
+        sums += [loss_sum / Y.shape[1] / len(windows), correct / Y.shape[1] / len(windows)]
+    values = torch.stack(sums).tolist()
+    out = {}
+    for i, split in enumerate(eval_sets):
+        out[split + '_loss'] = values[2 * i]
+        out[split + '_acc'] = values[2 * i + 1]
     model.train()
     return out
 
-class Head(nn.Module):
-    def __init__(self, head_size):
-        super().__init__()
-        self.key = nn.Linear(n_embd, head_size, bias=False)
-        self.query = nn.Linear(n_embd, head_size, bias=False)
-        self.value = nn.Linear(n_embd, head_size, bias=False)
-        self.register_buffer('tril', torch.tril(torch.ones(block_size, block_size)))
+def evaluation_worker(requests, results):
+    # Runs in a spawned process, which imports this file and so builds its own
+    # model and eval_sets. Scores every (iteration, state_dict) snapshot it is
+    # sent until it receives None.
+    for iteration, state_dict in iter(requests.get, None):
+        model.load_state_dict(state_dict)
+        results.put((iteration, estimate_loss()))
+
+class BackgroundEvaluator:
+    def __init__(self):
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.pending = 0
+        self.process = context.Process(target=evaluation_worker, args=(self.requests, self.results), daemon=True)
+        self.process.start()
+
+    def submit(self, iteration):
+        self.requests.put((iteration, snapshot(model.state_dict())))
+        self.pending += 1
+
+    def poll(self, block=False):
+        # The finished (iteration, metrics) pairs, in submission order. With
+        # block, waits for every submitted snapshot.
+        finished = []
+        while self.pending and (block or not self.results.empty()):
+            finished.append(self.results.get())
+            self.pending -= 1
+        return finished
+
+    def close(self):
+        self.requests.put(None)
+        self.process.join()
 
-        self.dropout = nn.Dropout(dropout)
-    def forward(self,x):
-        B,T,C = x.shape
-        k = self.key(x)
-        q = self.query(x)
-        wei = q @ k.transpose(-2,-1) * C**-0.5
-        wei = wei.masked_fill(self.tril[:T,:T] == 0, float('-inf'))
-        wei = F.softmax(wei, dim=-1)
-        wei = self.dropout(wei)
-        v = self.value(x)
-        out = wei @ v
-        return out
 class MultiHeadAttention(nn.Module):
+    # All heads share one fused QKV projection and run as a single batched
+    # attention, instead of a ModuleList of per-head Linear layers and masks.
     def __init__(self, num_heads, head_size):
         super().__init__()
-        self.heads = nn.ModuleList([Head(head_size) for _ in range(num_heads)])
+        self.num_heads = num_heads
+        self.head_size = head_size
+        self.qkv = nn.Linear(n_embd, 3 * num_heads * head_size, bias=False)
+        self.attn_dropout = nn.Dropout(dropout)
         self.proj = nn.Linear(n_embd, n_embd)
         self.dropout = nn.Dropout(dropout)
-    def forward(self, x):
-        out = torch.cat([h(x) for h in self.heads], dim=-1)
+    def forward(self, x, cache=None, mask=None, index=None):
+        B,T,C = x.shape
+        q, k, v = self.qkv(x).view(B, T, 3, self.num_heads, self.head_size).permute(2, 0, 3, 1, 4)
+        # With a cache the new keys and values are written into its buffers at
+        # the slots in index, and the queries attend over the whole buffer.
+        # The mask hides the slots that are not filled yet.
+        if cache is not None:
+            cache['k'].index_copy_(2, index, k)
+            cache['v'].index_copy_(2, index, v)
+            k, v = cache['k'], cache['v']
+        # Attention scores are scaled by C**-0.5 (n_embd, not head_size), as
+        # the per-head implementation did, so existing checkpoints behave the same.
+        if hasattr(F, 'scaled_dot_product_attention'):
+            q = q * (self.head_size / C) ** 0.5
+            dropout_p = dropout if self.training else 0.0
+            if mask is None:
+                out = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=True)
+            else:
+                out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout_p)
+        else:
+            if mask is None:
+                # Only this fallback needs an explicit causal mask, so it is
+                # built here rather than kept as a buffer in every layer.
+                mask = torch.ones(T, T, dtype=torch.bool, device=x.device).tril()
+            wei = q @ k.transpose(-2,-1) * C**-0.5
+            wei = wei.masked_fill(~mask, float('-inf'))
+            wei = F.softmax(wei, dim=-1)
+            wei = self.attn_dropout(wei)
+            out = wei @ v
+        out = out.transpose(1, 2).reshape(B, T, self.num_heads * self.head_size)
         out = self.dropout(self.proj(out))
         return out
+def convert_state_dict(state_dict):
+    # Maps checkpoints from the per-head layout (sa.heads.{h}.query/key/value
+    # and a tril buffer per head) onto the fused sa.qkv projection.
+    converted = {}
+    per_head = {}
+    for key, value in state_dict.items():
+        prefix, sep, rest = key.partition('.sa.heads.')
+        if not sep:
+            converted[key] = value
+            continue
+        head, name = rest.split('.', 1)
+        if name == 'tril':
+            continue
+        per_head.setdefault(prefix, {}).setdefault(name, {})[int(head)] = value
+    for prefix, weights in per_head.items():
+        converted[prefix + '.sa.qkv.weight'] = torch.cat(
+            [weights[name + '.weight'][h] for name in ('query', 'key', 'value') for h in sorted(weights[name + '.weight'])]
+        )
+    return converted
 class FeedForward(nn.Module):
     def __init__(self, n_embd):
         super().__init__()
@@ -207,10 +481,16 @@ class Block(nn.Module):
         self.ffwd = FeedForward(n_embd)
         self.ln1 = nn.LayerNorm(n_embd)
         self.ln2 = nn.LayerNorm(n_embd)
-    def forward(self, x):
-        x = x + self.sa(self.ln1(x))
+    def forward(self, x, cache=None, mask=None, index=None):
+        x = x + self.sa(self.ln1(x), cache, mask, index)
         x = x + self.ffwd(self.ln2(x))
         return x
+def bucket_size(n):
+    # Smallest power of two that holds n, capped at block_size.
+    size = 1
+    while size < n:
+        size *= 2
+    return min(size, block_size)
 class BigramLanguageModel(nn.Module):
     def __init__(self):
         super().__init__()
@@ -219,13 +499,31 @@ class BigramLanguageModel(nn.Module):
         self.blocks = nn.Sequential(*[Block(n_embd, n_head=n_head) for _ in range(n_layer)])
         self.ln_f = nn.LayerNorm(n_embd)
         self.lm_head = nn.Linear(n_embd, vocab_size)
-    def forward(self, idx, targets=None):
+        # Set to a CompiledFunction of this model to run generation compiled.
+        self.compiled_forward = None
+        self.checkpoint_every = activation_checkpoint_every
+    def forward(self, idx, targets=None, positions=None, mask=None, cache=None, index=None):
         B, T = idx.shape
 
+        if positions is None:
+            positions = torch.arange(T, device=device)
         tok_emd = self.token_embedding_table(idx)
-        pos_emb = self.position_embedding_table(torch.arange(T, device=device))
+        pos_emb = self.position_embedding_table(positions)
         x = tok_emd + pos_emb
-        x = self.blocks(x)
+        if cache is None and mask is None:
+            if self.checkpoint_every and self.training and torch.is_grad_enabled():
+                # The recompute replays the saved RNG state, so dropout
+                # masks, and the gradients, match the stored activations.
+                for i, block in enumerate(self.blocks):
+                    if i % self.checkpoint_every == 0:
+                        x = torch.utils.checkpoint.checkpoint(block, x, use_reentrant=False)
+                    else:
+                        x = block(x)
+            else:
+                x = self.blocks(x)
+        else:
+            for block, layer_cache in zip(self.blocks, cache or [None] * len(self.blocks)):
+                x = block(x, layer_cache, mask, index)
         x = self.ln_f(x)
         logits = self.lm_head(x)
 
@@ -239,18 +537,159 @@ class BigramLanguageModel(nn.Module):
             loss = F.cross_entropy(logits, targets)
 
         return logits, loss
+    def _width(self, n):
+        # A compiled forward is specialized to its input shapes, so sequence
+        # lengths are rounded up to a bucket and the extra columns left-padded.
+        # Generating then compiles a handful of graphs instead of one per length.
+        return n if self.compiled_forward is None else bucket_size(n)
+    def _attention_inputs(self, padding, start, T, S):
+        # Positions and mask for T queries at slots start..start+T over S key
+        # slots, for rows left-padded by padding[b] slots. Positions count from
+        # each row's first real token, and no real query attends to a pad key.
+        # Pad queries see only themselves so their rows stay finite.
+        queries = torch.arange(start, start + T, device=device)
+        keys = torch.arange(S, device=device)
+        mask = (keys[None, None, :] <= queries[None, :, None]) & (
+            (keys[None, None, :] >= padding[:, None, None]) | (keys[None, :] == queries[:, None])[None])
+        positions = (queries[None, :] - padding[:, None]).clamp(min=0)
+        return positions, mask[:, None]
+    def _next_logits(self, idx, padding, state):
+        # Logits for the token after each row of idx, which is left-padded by
+        # padding[b] tokens. In eval mode the prompt is run once and every
+        # later token reuses the keys and values kept in state, costing a
+        # single-position forward. Position embeddings are absolute, so once
+        # the sequence is longer than block_size the window shifts every
+        # position and each step falls back to a full forward over the last
+        # block_size tokens, as does training mode.
+        forward = self.compiled_forward or self
+        B, T = idx.shape
+        if self.training or T > block_size:
+            state.clear()
+            # Compiled graphs guard on strides as well as shapes, and slices of
+            # the growing idx have a new row stride every token. contiguous()
+            # keeps that stride when B == 1, so the slices are cloned.
+            window = idx[:, -block_size:].clone(memory_format=torch.contiguous_format)
+            padding = (padding - max(T - block_size, 0)).clamp(min=0)
+            width = self._width(window.shape[1])
+            extra = width - window.shape[1]
+            positions, mask = self._attention_inputs(padding + extra, 0, width, width)
+            logits, loss = forward(F.pad(window, (extra, 0)), positions=positions, mask=mask)
+            return logits[:, -1, :]
+        if not state:
+            # The cache keeps its own padding, which includes the bucket
+            # padding of the prompt, and grows in power-of-two steps.
+            width = self._width(T)
+            extra = width - T
+            capacity = bucket_size(width + 1)
+            shape = (B, n_head, capacity, n_embd // n_head)
+            dtype = self.lm_head.weight.dtype
+            state['cache'] = [{'k': torch.zeros(shape, dtype=dtype, device=device),
+                               'v': torch.zeros(shape, dtype=dtype, device=device)} for _ in self.blocks]
+            state['padding'] = padding + extra
+            state['length'] = width
+            positions, mask = self._attention_inputs(state['padding'], 0, width, capacity)
+            logits, loss = forward(F.pad(idx, (extra, 0)), positions=positions, mask=mask,
+                                   cache=state['cache'], index=torch.arange(width, device=device))
+            return logits[:, -1, :]
+        length = state['length']
+        capacity = state['cache'][0]['k'].shape[2]
+        if length == capacity:
+            if capacity < block_size:
+                grow = bucket_size(length + 1) - capacity
+                for layer_cache in state['cache']:
+                    layer_cache['k'] = F.pad(layer_cache['k'], (0, 0, 0, grow))
+                    layer_cache['v'] = F.pad(layer_cache['v'], (0, 0, 0, grow))
+                capacity += grow
+            else:
+                # A full block_size cache only happens with padding in every
+                # row, so those slots are dropped to make room. Positions are
+                # relative to the padding, so they do not change.
+                trim = int(state['padding'].min())
+                for layer_cache in state['cache']:
+                    layer_cache['k'][:, :, :length - trim] = layer_cache['k'][:, :, trim:length].clone()
+                    layer_cache['v'][:, :, :length - trim] = layer_cache['v'][:, :, trim:length].clone()
+                state['padding'] = state['padding'] - trim
+                length -= trim
+        positions, mask = self._attention_inputs(state['padding'], length, 1, capacity)
+        logits, loss = forward(idx[:, -1:].clone(memory_format=torch.contiguous_format), positions=positions, mask=mask,
+                               cache=state['cache'], index=torch.tensor([length], device=device))
+        state['length'] = length + 1
+        return logits[:, -1, :]
     def generate(self, idx, max_new_tokens):
+        for idx_next in self.generate_stream(idx, max_new_tokens):
+            idx = torch.cat((idx,idx_next), dim = 1)
+        return idx
+    @torch.no_grad()
+    def generate_stream(self, idx, max_new_tokens):
+        # Yields each sampled (B, 1) token as soon as it exists, so callers can
+        # pass ids through decode_stream and send text while generating.
+        padding = torch.zeros(idx.shape[0], dtype=torch.long, device=device)
+        state = {}
         for _ in range(max_new_tokens):
-            idx_cond = idx[:,-block_size:]
-            logits, loss = self(idx_cond)
-            logits = logits[:,-1,:]
+            logits = self._next_logits(idx, padding, state)
             probs = F.softmax(logits, dim=-1)
             idx_next = torch.multinomial(probs, num_samples=1)
             idx = torch.cat((idx,idx_next), dim = 1)
-        return idx
+            if profiler is not None:
+                profiler.step('generate')
+            yield idx_next
+    @torch.no_grad()
+    def generate_batch(self, prompts, max_new_tokens, stop_token=None):
+        # Samples all prompts together. Shorter prompts are left-padded, and a
+        # sequence leaves the batch (with its cache rows) once it produces
+        # stop_token, so the remaining rows keep running at a smaller batch.
+        lengths = [len(prompt) for prompt in prompts]
+        width = max(lengths)
+        idx = torch.zeros((len(prompts), width), dtype=torch.long, device=device)
+        for row, prompt in enumerate(prompts):
+            idx[row, width - len(prompt):] = torch.tensor(prompt, dtype=torch.long, device=device)
+        padding = torch.tensor([width - length for length in lengths], device=device)
+        rows = list(range(len(prompts)))
+        outputs = [list(prompt) for prompt in prompts]
+        state = {}
+        for _ in range(max_new_tokens):
+            logits = self._next_logits(idx, padding, state)
+            probs = F.softmax(logits, dim=-1)
+            idx_next = torch.multinomial(probs, num_samples=1)
+            idx = torch.cat((idx,idx_next), dim = 1)
+            if profiler is not None:
+                profiler.step('generate')
+
+            keep = []
+            for i, token in enumerate(idx_next[:, 0].tolist()):
+                outputs[rows[i]].append(token)
+                if token != stop_token:
+                    keep.append(i)
+            if not keep:
+                break
+            if len(keep) < len(rows):
+                keep_index = torch.tensor(keep, device=device)
+                idx = idx[keep_index]
+                padding = padding[keep_index]
+                rows = [rows[i] for i in keep]
+                if state:
+                    state['padding'] = state['padding'][keep_index]
+                    for layer_cache in state['cache']:
+                        layer_cache['k'] = layer_cache['k'][keep_index]
+                        layer_cache['v'] = layer_cache['v'][keep_index]
+                # Columns that are padding in every remaining row can go.
+                # Positions are relative to the padding, so they do not change.
+                trim = int(padding.min())
+                if trim:
+                    idx = idx[:, trim:]
+                    padding = padding - trim
+        return outputs
 model = BigramLanguageModel()
 
 m = model.to(device)
+train_forward = m
+ddp_model = None
+if distributed:
+    ddp_model = DistributedDataParallel(m)
+    train_forward = ddp_model
+if compile_model:
+    train_forward = CompiledFunction(train_forward, 'training step')
+    m.compiled_forward = CompiledFunction(m, 'generation forward')
 
 optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
 
@@ -259,7 +698,7 @@ print(f"Total number of parameters: {sum(p.numel() for p in model.parameters())}
 context = torch.zeros((1, 1), dtype=torch.long, device=device)
 
 
-def save_model_with_version(model, directory='./', base_name='model_state_dict', hyperparameters=None, training_time=None, final_losses=None):
+def save_model_with_version(model, directory='./', base_name='model_state_dict', hyperparameters=None, training_time=None, final_losses=None, tokenizer=None, run_stats=None):
     version = get_next_version(base_name, directory)
     while os.path.exists(os.path.join(directory, f"{base_name}_v{version}.pth")):
         version += 1
@@ -267,6 +706,11 @@ def save_model_with_version(model, directory='./', base_name='model_state_dict',
     torch.save(model.state_dict(), file_path)
     print(f"Model saved as {file_path}")
 
+    if isinstance(tokenizer, WordTokenizer):
+        vocab_file_path = os.path.join(directory, f"{base_name}_v{version}_vocab.json")
+        tokenizer.save_vocab(vocab_file_path)
+        print(f"Vocabulary saved as {vocab_file_path}")
+
     if hyperparameters is not None and training_time is not None and final_losses is not None:
         final_losses = {k: float(v) for k, v in final_losses.items()}
         metadata = {
@@ -274,6 +718,8 @@ def save_model_with_version(model, directory='./', base_name='model_state_dict',
             'training_time': training_time,
             'final_losses': final_losses
         }
+        if run_stats is not None:
+            metadata['run_stats'] = run_stats
         print(final_losses)
         metadata_file_path = os.path.join(directory, f"{base_name}_v{version}_metadata.json")
         with open(metadata_file_path, 'w') as f:
@@ -285,8 +731,9 @@ from fastapi import FastAPI
 
 app = FastAPI()
 
-def load_model():
-    model.load_state_dict(torch.load('./model_state_dict_v41.pth', weights_only=True))
+def load_model(model_file='./model_state_dict_v41.pth', max_new_tokens=50):
+    model.load_state_dict(convert_state_dict(torch.load(model_file, weights_only=True)))
+    model.eval()
     hardcoded_inputs = [#"Hvilke AI-tools anbefaler I til contentproduktion og kundeservice og kan jeg lære dem via jer?",
                        #"Hvordan fungerer jeres AI-coaching og hvad lærer jeg konkret?",
                        "Hvordan adskiller jeres AI-løsninger sig fra andre bureauers?",
@@ -298,9 +745,7 @@ def load_model():
                        "Hvilke resultater har I tidligere skabt og hvad kan jeg realistisk forvente?",
                         "Kan I hjælpe mig med at automatisere mine arbejdsgange med AI og i så fald hvordan?"]
     output_list = []
-    for x in hardcoded_inputs:
-        context = torch.tensor([encode(x)], dtype=torch.long, device=device)
-        generated_tokens = m.generate(context, max_new_tokens=50)[0].tolist()
+    for generated_tokens in m.generate_batch([encode(x) for x in hardcoded_inputs], max_new_tokens=max_new_tokens):
         print(decode(generated_tokens))
     return output_list
 
@@ -309,6 +754,137 @@ async def read_root():
     response = load_model()
     return {"message": response}
 
+def time_calls(fn, calls=5):
+    fn()
+    synchronize()
+    start = time.time()
+    for _ in range(calls):
+        fn()
+    synchronize()
+    return (time.time() - start) / calls
+
+def compile_report(xb, yb, max_new_tokens=100):
+    # Times the same forward and backward pass, and the same generation, in
+    # eager and compiled mode once everything has been compiled, so the
+    # metadata records what compiling bought next to what it cost.
+    def train_step(forward):
+        def step():
+            with autocast():
+                logits, loss = forward(xb, yb)
+            loss.backward()
+        return step
+    eager_step = time_calls(train_step(m))
+    compiled_step = time_calls(train_step(train_forward))
+    m.zero_grad(set_to_none=True)
+
+    compiled_forward = m.compiled_forward
+    m.eval()
+    m.compiled_forward = None
+    eager_generate = time_calls(lambda: m.generate(context, max_new_tokens=max_new_tokens))
+    m.compiled_forward = compiled_forward
+    compiled_generate = time_calls(lambda: m.generate(context, max_new_tokens=max_new_tokens))
+    m.train()
+    return {
+        'train': dict(train_forward.stats(), eager_step_seconds=eager_step, compiled_step_seconds=compiled_step,
+                      speedup=eager_step / compiled_step),
+        'generate': dict(compiled_forward.stats(), eager_seconds=eager_generate, compiled_seconds=compiled_generate,
+                         max_new_tokens=max_new_tokens, speedup=eager_generate / compiled_generate),
+    }
+
+def training_state(iteration, scaler, metrics):
+    # Called on every rank, since the RNG states of all ranks are gathered,
+    # but only rank 0 gets the snapshot; the other ranks get None.
+    rng = {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if device == 'cuda' else None
+    }
+    if distributed:
+        ranks_rng = [None] * world_size
+        torch.distributed.all_gather_object(ranks_rng, rng)
+        rng = ranks_rng
+    if rank != 0:
+        return None
+    return snapshot({
+        'iteration': iteration,
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scaler': scaler.state_dict(),
+        'rng': rng,
+        'loaders': {
+            'train': {'seed': train_loader.seed, 'batches': train_loader.batches}
+        },
+        'metrics': {name: [float(value) for value in values] for name, values in metrics.items()},
+        'elapsed': time.time() - start_time,
+        'hyperparameters': hyperparameters
+    })
+
+def load_training_state(checkpoint_path, scaler):
+    # Restores everything training_state saved and returns the checkpoint.
+    # The sampler is rebuilt from its seed and fast-forwarded past the
+    # batches already used, so the run continues exactly where it stopped.
+    global start_time, train_loader
+    if checkpoint_path == 'latest':
+        checkpoint_path = latest_checkpoint(checkpoint_dir)
+        if checkpoint_path is None:
+            raise FileNotFoundError(f"No checkpoints to resume from in {checkpoint_dir}")
+    checkpoint = torch.load(checkpoint_path, weights_only=True)
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    scaler.load_state_dict(checkpoint['scaler'])
+    rng = checkpoint['rng']
+    if isinstance(rng, list):
+        if len(rng) != world_size:
+            raise ValueError(f"{checkpoint_path} was written by {len(rng)} processes; resume it with as many")
+        rng = rng[rank]
+    elif world_size != 1:
+        raise ValueError(f"{checkpoint_path} was written by a single process; resume it without torchrun")
+    torch.set_rng_state(rng['torch'])
+    if device == 'cuda' and rng['cuda'] is not None:
+        torch.cuda.set_rng_state_all(rng['cuda'])
+    loaders = checkpoint['loaders']
+    train_loader = BatchLoader(train_data, batch_size, block_size, device, seed=loaders['train']['seed'],
+                               prefetch=prefetch_batches, skip=loaders['train']['batches'], rank=rank, world_size=world_size)
+    start_time = time.time() - checkpoint['elapsed']
+    print(f"Resuming from {checkpoint_path} at iteration {checkpoint['iteration']}")
+    return checkpoint
+
+def saved_activation_bytes(fn):
+    # Bytes of the non-parameter tensors autograd keeps for the backward pass
+    # while fn runs, the memory activation checkpointing gives up.
+    parameters = {p.data_ptr() for p in model.parameters()}
+    saved = {}
+    def pack(tensor):
+        if tensor.data_ptr() not in parameters:
+            saved[tensor.data_ptr()] = max(saved.get(tensor.data_ptr(), 0), tensor.numel() * tensor.element_size())
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(saved.values())
+
+def activation_checkpoint_report(xb, yb):
+    # Runs the same eager forward and backward pass with every activation
+    # stored and with the configured checkpointing, and reports what each
+    # keeps for backward, its peak memory on CUDA and its step time.
+    def train_step():
+        with autocast():
+            logits, loss = m(xb, yb)
+        loss.backward()
+    report = {}
+    for setting in (None, activation_checkpoint_every):
+        m.checkpoint_every = setting
+        if device == 'cuda':
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+        saved_bytes = saved_activation_bytes(train_step)
+        step_seconds = time_calls(train_step)
+        report['none' if setting is None else f'every_{setting}'] = {
+            'saved_activation_bytes': saved_bytes,
+            'peak_memory_bytes': torch.cuda.max_memory_allocated() if device == 'cuda' else None,
+            'step_seconds': step_seconds
+        }
+    m.zero_grad(set_to_none=True)
+    return report
+
 def get_next_version(base_name='model_state_dict', directory='./'):
     version = 1
     while os.path.exists(os.path.join(directory, f"{base_name}_v{version}.pth")):
@@ -318,52 +894,153 @@ def get_next_version(base_name='model_state_dict', directory='./'):
 import matplotlib.pyplot as plt
 
 
-def train_model():
+def train_model(resume=None):
     iter_start_time = time.time()
     train_losses = []
     val_losses = []
     train_accuracies = []
     val_accuracies = []
-
-
-    for iter in range(max_iters):
-        print(f"iteration {iter}")
-        if iter % eval_interval == 0:
-            metrics = estimate_loss()
-            train_losses.append(metrics['train_loss'])
-            val_losses.append(metrics['val_loss'])
-            train_accuracies.append(metrics['train_acc'])
-            val_accuracies.append(metrics['val_acc'])
-            print("Evaluation metrics:")
-            print(f"train loss: {metrics['train_loss']:.4f}, train acc: {metrics['train_acc']:.4f}")
-            print(f"val loss: {metrics['val_loss']:.4f}, val acc: {metrics['val_acc']:.4f}")
-            print(f"step {iter}: train loss {metrics['train_loss']:.4f}, val loss {metrics['val_loss']:.4f}")
+    metrics_history = {
+        'train_losses': train_losses,
+        'val_losses': val_losses,
+        'train_accuracies': train_accuracies,
+        'val_accuracies': val_accuracies
+    }
+
+
+    scaler = torch.amp.GradScaler('cuda', enabled=precision == 'fp16')
+    start_iter = 0
+    if resume is not None:
+        checkpoint = load_training_state(resume, scaler)
+        start_iter = checkpoint['iteration']
+        for name, values in checkpoint['metrics'].items():
+            metrics_history[name].extend(values)
+    checkpoint_writer = CheckpointWriter(checkpoint_dir, keep_checkpoints) if checkpoint_interval and rank == 0 else None
+    metrics_path = os.path.join(output_dir, metrics_file)
+    recorder = MetricsRecorder(metrics_path, append=resume is not None) if rank == 0 else None
+    timer = PhaseTimer(device)
+    tokens_per_step = world_size * grad_accum_steps * batch_size * block_size
+    loop_start_time = time.time()
+    def record(iter, metrics):
+        recorder.record('eval', iter=iter, peak_memory_bytes=peak_memory_bytes(), **metrics)
+        train_losses.append(metrics['train_loss'])
+        val_losses.append(metrics['val_loss'])
+        train_accuracies.append(metrics['train_acc'])
+        val_accuracies.append(metrics['val_acc'])
+        print("Evaluation metrics:")
+        print(f"train loss: {metrics['train_loss']:.4f}, train acc: {metrics['train_acc']:.4f}")
+        print(f"val loss: {metrics['val_loss']:.4f}, val acc: {metrics['val_acc']:.4f}")
+        print(f"step {iter}: train loss {metrics['train_loss']:.4f}, val loss {metrics['val_loss']:.4f}")
+
+    evaluator = BackgroundEvaluator() if eval_in_background and rank == 0 else None
+    for iter in range(start_iter, max_iters):
+        if iter % eval_interval == 0 and rank == 0:
+            if evaluator is not None:
+                evaluator.submit(iter)
+            else:
+                record(iter, estimate_loss())
             iter_end_time = time.time()
             iter_elapsed_time = iter_end_time - iter_start_time
             iter_start_time = time.time()
             print(f"Iteration {iter} time: {iter_elapsed_time:.2f} seconds")
+        if evaluator is not None:
+            for eval_iter, metrics in evaluator.poll():
+                record(eval_iter, metrics)
 
-        xb, yb = get_batch('train')
-        logits, loss = m(xb, yb)
         optimizer.zero_grad(set_to_none=True)
-        loss.backward()
-        optimizer.step()
-
-    print(decode(m.generate(context, max_new_tokens=500)[0].tolist()))
+        timer.mark('start')
+        data_wait = 0.0
+        for micro_step in range(grad_accum_steps):
+            xb, yb = get_batch()
+            data_wait += train_loader.wait_seconds
+            timer.mark('data')
+            # Gradients are averaged across ranks only on the last micro-batch.
+            if ddp_model is not None and micro_step < grad_accum_steps - 1:
+                sync = ddp_model.no_sync()
+            else:
+                sync = contextlib.nullcontext()
+            with sync:
+                with autocast():
+                    logits, loss = train_forward(xb, yb)
+                timer.mark('forward')
+                scaler.scale(loss / grad_accum_steps).backward()
+                timer.mark('backward')
+        scaler.step(optimizer)
+        scaler.update()
+        timer.mark('optimizer')
+        if recorder is not None:
+            recorder.record('step', iter=iter, tokens=tokens_per_step, data_wait=data_wait, phases=timer.take())
+        else:
+            timer.take()
+        if profiler is not None:
+            profiler.step('train')
+        if checkpoint_interval and (iter + 1) % checkpoint_interval == 0:
+            # The metric history in a checkpoint has to be complete.
+            if evaluator is not None:
+                for eval_iter, metrics in evaluator.poll(block=True):
+                    record(eval_iter, metrics)
+            state = training_state(iter + 1, scaler, metrics_history)
+            if checkpoint_writer is not None:
+                checkpoint_writer.save(iter + 1, state)
+    loop_time = time.time() - loop_start_time
+    if checkpoint_writer is not None:
+        checkpoint_writer.wait()
+    if evaluator is not None:
+        for eval_iter, metrics in evaluator.poll(block=True):
+            record(eval_iter, metrics)
+        evaluator.close()
+    if recorder is not None:
+        recorder.record('memory', iter=max_iters, peak_memory_bytes=peak_memory_bytes())
+        recorder.close()
+
+    if rank == 0:
+        print(decode(m.generate(context, max_new_tokens=500)[0].tolist()))
 
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Training time: {elapsed_time:.2f} seconds")
-    final_losses = estimate_loss()
-
-    save_model_with_version(m, hyperparameters=hyperparameters, training_time=elapsed_time, final_losses=final_losses)
-    version = get_next_version()
+    final_losses = estimate_loss() if rank == 0 else None
+
+    # Tokens/sec counts every rank's tokens; peak memory is rank 0's.
+    run_stats = {
+        'tokens_per_sec': (max_iters - start_iter) * tokens_per_step / loop_time,
+        'peak_memory_bytes': peak_memory_bytes()
+    }
+    if rank == 0:
+        # Step times exclude evaluation and checkpointing, unlike tokens_per_sec.
+        run_stats['telemetry'] = summarize(read_metrics(metrics_path))
+        if run_stats['telemetry'] is not None:
+            step_seconds = run_stats['telemetry']['step_seconds']
+            print(f"Step time p50 {step_seconds['p50'] * 1000:.1f} ms, p90 {step_seconds['p90'] * 1000:.1f} ms, "
+                  f"p99 {step_seconds['p99'] * 1000:.1f} ms")
+    print(f"Tokens/sec: {run_stats['tokens_per_sec']:.0f}")
+    if compile_model:
+        # Every rank takes part, since the compiled steps all-reduce.
+        run_stats['compile'] = compile_report(xb, yb)
+        print(f"Compiled speedup: training step {run_stats['compile']['train']['speedup']:.2f}x, "
+              f"generation {run_stats['compile']['generate']['speedup']:.2f}x")
+    if distributed:
+        torch.distributed.destroy_process_group()
+    if rank != 0:
+        return
+    if activation_checkpoint_every:
+        run_stats['activation_checkpointing'] = report = activation_checkpoint_report(xb, yb)
+        stored, checkpointed = report['none'], report[f'every_{activation_checkpoint_every}']
+        print(f"Activation checkpointing every {activation_checkpoint_every} blocks: saved activations "
+              f"{stored['saved_activation_bytes'] / 2**20:.0f} -> {checkpointed['saved_activation_bytes'] / 2**20:.0f} MiB, "
+              f"step time {stored['step_seconds'] * 1000:.0f} -> {checkpointed['step_seconds'] * 1000:.0f} ms")
+    save_model_with_version(m, directory=output_dir, hyperparameters=hyperparameters, training_time=elapsed_time, final_losses=final_losses, tokenizer=tokenizer, run_stats=run_stats)
+    version = get_next_version(directory=output_dir)
+
+    # A resumed run may have evaluated an iteration again; the last record wins.
+    evals = {record['iter']: record for record in read_metrics(metrics_path) if record['kind'] == 'eval'}
+    eval_iters_logged = sorted(evals)
 
     plt.figure(figsize=(12, 10))
 
     plt.subplot(2, 1, 1)
-    plt.plot(range(0, max_iters, eval_interval), train_losses, label='Train Loss')
-    plt.plot(range(0, max_iters, eval_interval), val_losses, label='Validation Loss')
+    plt.plot(eval_iters_logged, [evals[i]['train_loss'] for i in eval_iters_logged], label='Train Loss')
+    plt.plot(eval_iters_logged, [evals[i]['val_loss'] for i in eval_iters_logged], label='Validation Loss')
     plt.xlabel('Iterations')
     plt.ylabel('Loss')
     plt.title('Training and Validation Loss')
@@ -371,8 +1048,8 @@ def train_model():
     plt.grid(True)
 
     plt.subplot(2, 1, 2)
-    plt.plot(range(0, max_iters, eval_interval), train_accuracies, label='Train Accuracy')
-    plt.plot(range(0, max_iters, eval_interval), val_accuracies, label='Validation Accuracy')
+    plt.plot(eval_iters_logged, [evals[i]['train_acc'] for i in eval_iters_logged], label='Train Accuracy')
+    plt.plot(eval_iters_logged, [evals[i]['val_acc'] for i in eval_iters_logged], label='Validation Accuracy')
     plt.xlabel('Iterations')
     plt.ylabel('Accuracy')
     plt.title('Training and Validation Accuracy')
@@ -380,9 +1057,31 @@ def train_model():
     plt.grid(True)
 
     plt.tight_layout()
-    graph_filename = f"metrics_graph_v{version}.png"
+    graph_filename = os.path.join(output_dir, f"metrics_graph_v{version}.png")
     plt.savefig(graph_filename)
     plt.show()
 #response = load_model()
-train_model()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the model with the settings at the top of this file.')
+    parser.add_argument('--resume', nargs='?', const='latest', metavar='CHECKPOINT',
+                        help=f'continue from a checkpoint, by default the newest one in {checkpoint_dir}')
+    parser.add_argument('--profile', choices=['train', 'generate'],
+                        help='profile a window of training steps or of generated tokens')
+    parser.add_argument('--profile-start', type=int, default=10, help='steps to skip before the window')
+    parser.add_argument('--profile-steps', type=int, default=5, help='steps in the window')
+    parser.add_argument('--profile-top', type=int, default=20, help='rows in the operator tables')
+    parser.add_argument('--profile-dir', default='profiles')
+    parser.add_argument('--model-file', default='./model_state_dict_v41.pth',
+                        help='weights to generate from with --profile generate, which skips training')
+    args = parser.parse_args()
+    if args.profile is not None:
+        profiler = Profiler(args.profile, m, (Block, MultiHeadAttention, FeedForward), start=args.profile_start,
+                            steps=args.profile_steps, top=args.profile_top, device=device,
+                            output_dir=os.path.join(args.profile_dir, f"rank{rank}") if distributed else args.profile_dir)
+    if args.profile == 'generate':
+        load_model(args.model_file, max_new_tokens=max(50, args.profile_start + args.profile_steps))
+    else:
+        train_model(resume=args.resume)
+    if profiler is not None:
+        profiler.close()
 
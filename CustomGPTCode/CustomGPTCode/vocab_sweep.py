@@ -0,0 +1,66 @@
+import argparse
+import contextlib
+import json
+import os
+import time
+
+from tokenization import Tokenizer, file_digest, token_cache_path, write_token_cache
+
+
+def vocab_sweep(dataset_file, vocab_sizes, output_dir='./', cache_dir='token_cache', by_words=False):
+    # Trains once to the largest vocabulary. Every smaller size is a prefix of
+    # that merge list, so its merges file, token cache and compression
+    # statistics come from truncating the run instead of retraining.
+    vocab_sizes = sorted(set(vocab_sizes))
+    stem = os.path.splitext(os.path.basename(dataset_file))[0]
+    tokenizer = Tokenizer(vocab_sizes[-1])
+    tokenizer.load_text(dataset_file, stream=True)
+    num_bytes = len(tokenizer.tokens)
+
+    print(f"training {vocab_sizes[-1]} vocab on {dataset_file}")
+    start = time.time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        tokenizer.tokenize(by_words=by_words)
+    training_time = time.time() - start
+    print(f"Training time: {training_time:.2f} seconds")
+
+    results = []
+    for vocab_size in vocab_sizes:
+        sized = tokenizer.truncated(vocab_size)
+        merges_file = os.path.join(output_dir, f"merge_{stem}_{vocab_size}.json")
+        sized.save_merges(merges_file)
+        ids = sized.encode_to_array(dataset_file)
+        cache_path, typecode = token_cache_path(cache_dir, dataset_file, 'bpe:' + file_digest(merges_file), vocab_size)
+        write_token_cache(cache_path, typecode, ids)
+        results.append({
+            'vocab_size': vocab_size,
+            'merges_file': merges_file,
+            'token_cache': cache_path,
+            'num_tokens': len(ids),
+            'compression_ratio': num_bytes / max(len(ids), 1),
+        })
+        print(f"vocab {vocab_size}: {len(ids)} tokens, compression ratio {results[-1]['compression_ratio']:.2f}X")
+
+    summary = {
+        'dataset_file': dataset_file,
+        'dataset_bytes': num_bytes,
+        'by_words': by_words,
+        'training_time': training_time,
+        'results': results,
+    }
+    summary_path = os.path.join(output_dir, f"vocab_sweep_{stem}.json")
+    with open(summary_path, 'w') as file:
+        json.dump(summary, file, indent=4)
+    print(f"Summary saved as {summary_path}")
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train BPE once and derive every smaller vocabulary from it.')
+    parser.add_argument('dataset_file')
+    parser.add_argument('vocab_sizes', nargs='+', type=int)
+    parser.add_argument('--output-dir', default='./')
+    parser.add_argument('--cache-dir', default='token_cache')
+    parser.add_argument('--by-words', action='store_true')
+    args = parser.parse_args()
+    vocab_sweep(args.dataset_file, args.vocab_sizes, args.output_dir, args.cache_dir, args.by_words)
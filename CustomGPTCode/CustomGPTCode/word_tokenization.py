@@ -0,0 +1,99 @@
+# word_tokenization.py
+import hashlib
+import json
+from collections import Counter
+from itertools import repeat
+
+import numpy as np
+
+UNK = '<unk>'
+
+
+class WordTokenizer:
+    # Whitespace word tokenizer with the same interface as Tokenizer. Without
+    # a vocab_size cutoff the ids are the sorted unique words, as the word
+    # tokenization in train.py always produced, so older checkpoints keep
+    # lining up. With a cutoff, the most frequent words are kept and every
+    # other word maps to a trailing <unk> id.
+    def __init__(self, vocab_size=None):
+        self.vocab_size = vocab_size
+        self.max_vocab_size = vocab_size
+        self.words = []
+        self.stoi = {}
+        self.unk = None
+
+    def load_text(self, file_path):
+        self.file_path = file_path
+
+    def tokenize(self):
+        counts = Counter()
+        with open(self.file_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                counts.update(line.split())
+        if self.max_vocab_size is None or len(counts) <= self.max_vocab_size:
+            self._set_words(sorted(counts), None)
+        else:
+            kept = sorted(counts, key=lambda word: (-counts[word], word))[:self.max_vocab_size - 1]
+            words = sorted(kept)
+            self._set_words(words + [UNK], len(words))
+
+    def _set_words(self, words, unk):
+        self.words = words
+        self.stoi = {word: i for i, word in enumerate(words)}
+        self.unk = unk
+        self.vocab_size = len(words)
+
+    def _serialize_vocab(self):
+        return json.dumps({'words': self.words, 'unk': self.unk}, ensure_ascii=False)
+
+    def config(self):
+        # Identifies the vocabulary by its contents: the sha256 of the file
+        # save_vocab writes. A vocabulary loaded from vocab_file and the same
+        # one rebuilt from the dataset share token caches and shards, and
+        # different vocabularies never do.
+        return 'words:' + hashlib.sha256(self._serialize_vocab().encode('utf-8')).hexdigest()
+
+    def save_vocab(self, file_path):
+        with open(file_path, 'w', encoding='utf-8') as file:
+            file.write(self._serialize_vocab())
+
+    def load_vocab(self, file_path):
+        with open(file_path, 'r', encoding='utf-8') as file:
+            vocab = json.load(file)
+        self._set_words(vocab['words'], vocab['unk'])
+
+    def _encode_words(self, words):
+        # The dict lookups fill an int32 array directly, without building a
+        # list of Python ints first.
+        if self.unk is None:
+            ids = map(self.stoi.__getitem__, words)
+        else:
+            ids = map(self.stoi.get, words, repeat(self.unk))
+        return np.fromiter(ids, dtype=np.int32, count=len(words))
+
+    def encode(self, text):
+        return self._encode_words(text.split()).tolist()
+
+    def decode(self, ids):
+        return ' '.join(self.words[i] for i in ids)
+
+    def decode_stream(self, ids):
+        separator = ''
+        for i in ids:
+            yield separator + self.words[i]
+            separator = ' '
+
+    def iter_encode_file(self, file_path, chunk_lines=1 << 16):
+        with open(file_path, 'r', encoding='utf-8') as file:
+            words = []
+            for line_number, line in enumerate(file, 1):
+                words.extend(line.split())
+                if line_number % chunk_lines == 0:
+                    yield self._encode_words(words)
+                    words = []
+            if words:
+                yield self._encode_words(words)
+
+    def encode_to_array(self, file_path, chunk_lines=1 << 16):
+        chunks = list(self.iter_encode_file(file_path, chunk_lines))
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)